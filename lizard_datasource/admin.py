@@ -34,6 +34,9 @@ class DatasourceModelAdmin(admin.ModelAdmin):
                            'script_last_run_started',
                            'script_run_next_opportunity'
                            ]
+                }),
+        ('Timeseries cache', {
+                'fields': ['timeseries_cache_ttl']
                 }))
     readonly_fields = [
         'originating_app', 'identifier', 'script_last_run_started']
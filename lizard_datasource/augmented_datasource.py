@@ -18,19 +18,45 @@ from __future__ import absolute_import, division
 
 import logging
 
+from array import array
+from itertools import islice
+from itertools import izip
+
 from lizard_map import coordinates
+import numpy
 
 from lizard_datasource import datasource
+from lizard_datasource import location
 from lizard_datasource import models
+from lizard_datasource import timeseries as timeseries_module
 
 logger = logging.getLogger(__name__)
 
+# Locations are colored this many at a time
+COLOR_CHUNK_SIZE = 1000
+
+
+def _timeseries_many(source, location_ids, start_datetime, end_datetime,
+                     max_points):
+    """Call source.timeseries_many(), passing max_points only if it is
+    set, so that datasources that override timeseries_many() without
+    it keep working."""
+    if max_points is None:
+        return source.timeseries_many(
+            location_ids, start_datetime, end_datetime)
+    return source.timeseries_many(
+        location_ids, start_datetime, end_datetime, max_points=max_points)
+
 
 class AugmentedDataSource(datasource.DataSource):
     """By default this just forwards most important methods to the
     datasource that's being augmented. Before returning some results
     may or may not be, well, augmented."""
 
+    # chooseable_criteria() is that of the original datasource, which
+    # uses its own snapshot
+    USE_CRITERIA_SNAPSHOT = False
+
     def __init__(self, config_object):
         """Initialize the object.
 
@@ -46,12 +72,19 @@ class AugmentedDataSource(datasource.DataSource):
         AugmentedDataSource object."""
 
         if not hasattr(self, '_original_datasource'):
+            # This is a copy, so we can set our choices made on it
             self._original_datasource = datasource.get_datasource_by_model(
                 self.config_object.augmented_source,
                 exclude=self)
 
         return self._original_datasource
 
+    def copy(self):
+        augmented = super(AugmentedDataSource, self).copy()
+        if getattr(self, '_original_datasource', None) is not None:
+            augmented._original_datasource = self._original_datasource.copy()
+        return augmented
+
     @property
     def PROPERTIES(self):
         return self.original_datasource.PROPERTIES
@@ -73,7 +106,8 @@ class AugmentedDataSource(datasource.DataSource):
         return self.original_datasource.criteria()
 
     def options_for_criterion(self, criterion):
-        return self.original_datasource.options_for_criterion(criterion)
+        return self.original_datasource.memoized_options_for_criterion(
+            criterion)
 
     def chooseable_criteria(self):
         """Just return the chooseable criteria of the original
@@ -147,6 +181,46 @@ class AugmentedDataSource(datasource.DataSource):
         except models.ColorFromLatestValue.DoesNotExist:
             return None
 
+    def _cached_values(self, colorfrom):
+        """Return a dict with the cached latest value of each location
+        in the layer that colorfrom gets its colors from."""
+        if not colorfrom.layer_to_get_color_from:
+            return {}
+
+        return dict(models.DatasourceCache.objects.filter(
+                datasource_layer=colorfrom.layer_to_get_color_from
+                ).values_list('locationid', 'value').iterator())
+
+    def _colors(self, location_ids, cached_values, colormap):
+        """Return an array with the colors of the location ids, without
+        leading '#'. Locations without a cached value are gray."""
+        has_value = numpy.array(
+            [location_id in cached_values for location_id in location_ids],
+            dtype=bool)
+        values = numpy.array(
+            [cached_values.get(location_id, numpy.nan)
+             for location_id in location_ids], dtype=float)
+
+        colors = colormap.colors_for(values)
+        colors[~has_value] = "888888"  # Default is gray
+        for i, color in enumerate(colors):
+            if color and color.startswith("#"):
+                colors[i] = color[1:]
+        return colors
+
+    def location_colors(self, location_ids):
+        """Return an array with the color of each of the location ids,
+        in the same order, or None if this layer has no colors. Use
+        this instead of locations(bare=False) to get the colors without
+        changing Location objects."""
+        colorfrom = self._colorfrom()
+        if not colorfrom:
+            return None
+
+        return self._colors(
+            list(location_ids), self._cached_values(colorfrom),
+            colorfrom.colormap.compiled())
+
     def locations(self, bare=False):
         locations = self.original_datasource.locations(bare=bare)
 
@@ -154,29 +228,35 @@ class AugmentedDataSource(datasource.DataSource):
             colorfrom = self._colorfrom()
 
         if bare or not colorfrom:
-            for location in locations:
-                yield location
+            for point in locations:
+                yield point
             return
 
-        cached_values = dict()
-
-        colormap = colorfrom.colormap
-        if colorfrom.layer_to_get_color_from:
-            for cached_value in models.DatasourceCache.objects.filter(
-                datasource_layer=colorfrom.layer_to_get_color_from):
-                cached_values[cached_value.locationid] = (
-                    cached_value.value)
+        cached_values = self._cached_values(colorfrom)
+        colormap = colorfrom.colormap.compiled()
 
-        for location in locations:
-            color = "888888"  # Default is gray
-            if location.identifier in cached_values:
-                value = cached_values[location.identifier]
-                color = colormap.color_for(value)
-                if color.startswith("#"):
-                    color = color[1:]
+        if isinstance(locations, location.LocationSet):
+            # Color the whole column at once
+            locations = locations.with_colors(self._colors(
+                    locations.identifiers, cached_values, colormap))
+            for point in locations:
+                yield point
+            return
 
-            location.color = color
-            yield location
+        # Color the locations a chunk at a time, so that we can start
+        # yielding before all locations are known
+        locations = iter(locations)
+        while True:
+            chunk = list(islice(locations, COLOR_CHUNK_SIZE))
+            if not chunk:
+                return
+
+            colors = self._colors(
+                [point.identifier for point in chunk],
+                cached_values, colormap)
+            for point, color in izip(chunk, colors):
+                point.color = color
+                yield point
 
     def location_annotations(self):
         """If we have colors, we should have a legend for them."""
@@ -191,49 +271,103 @@ class AugmentedDataSource(datasource.DataSource):
 
         return annotations
 
-    def timeseries(self, location_id, start_datetime=None, end_datetime=None):
-        timeseries = self.original_datasource.timeseries(
-            location_id, start_datetime, end_datetime)
+    def timeseries(self, location_id, start_datetime=None, end_datetime=None,
+                   max_points=None):
+        """If max_points is given, it is passed on to the original
+        datasource and the datasources of the extra graph lines, see
+        DataSource.timeseries_downsampled()."""
+        return self.timeseries_many(
+            [location_id], start_datetime, end_datetime,
+            max_points=max_points)[location_id]
+
+    def timeseries_downsampled(
+        self, location_id, start_datetime=None, end_datetime=None,
+        max_points=None, method='lttb'):
+        if method != 'lttb':
+            return super(AugmentedDataSource, self).timeseries_downsampled(
+                location_id, start_datetime, end_datetime, max_points, method)
+        return self.timeseries(
+            location_id, start_datetime, end_datetime, max_points)
+
+    def timeseries_many(
+        self, location_ids, start_datetime=None, end_datetime=None,
+        max_points=None):
+        """Get the timeseries of all the location ids from the
+        original datasource at once, then add the extra graph lines to
+        them, with one request per extra graph line."""
+        location_ids = list(location_ids)
+        timeseries = _timeseries_many(
+            self.original_datasource, location_ids,
+            start_datetime, end_datetime, max_points)
+
+        # Extra timeseries per location id, merged at the end so that
+        # the dates are aligned only once
+        extra_lines = dict(
+            (location_id, []) for location_id in location_ids)
 
         for extra_graph_line in models.ExtraGraphLine.objects.filter(
             layer_to_add_line_to=self.datasource_layer):
 
-            extra_identifier = extra_graph_line.map_identifier(location_id)
-            if not extra_identifier:
-                # There is a mapping, but this ID isn't found in it -- skip
-                continue
+            extra_identifiers = extra_graph_line.map_identifiers(
+                location_ids)
 
             # Get datasource to get the extra timeseries from
             layer_from = extra_graph_line.layer_to_get_line_from
             source = datasource.get_datasource_by_layer(layer_from)
-            extra_timeseries = source.timeseries(
-                extra_identifier,
-                start_datetime, end_datetime)
-            if extra_timeseries:
-                timeseries.add(extra_timeseries)
+            extra_timeseries = _timeseries_many(
+                source,
+                set(extra_identifier
+                    for extra_identifier in extra_identifiers.values()
+                    if extra_identifier),
+                start_datetime, end_datetime, max_points)
+
+            for location_id, extra_identifier in extra_identifiers.items():
+                if not extra_identifier:
+                    # There is a mapping, but this ID isn't found in
+                    # it -- skip
+                    continue
+                if timeseries.get(location_id) is None:
+                    continue
+                if extra_timeseries.get(extra_identifier):
+                    extra_lines[location_id].append(
+                        extra_timeseries[extra_identifier])
+
+        for location_id, extra_line_list in extra_lines.items():
+            if extra_line_list:
+                timeseries[location_id] = timeseries_module.merge(
+                    [timeseries[location_id]] + extra_line_list)
 
         return timeseries
 
+    def latest_values(self):
+        return self.original_datasource.latest_values()
+
     def has_percentiles(self):
         return models.PercentileLayer.objects.filter(
             layer_to_add_percentile_to=self.datasource_layer
             ).exists()
 
-    def percentiles(self, location_id, start_datetime=None, end_datetime=None):
+    def percentiles(self, location_id, start_datetime=None, end_datetime=None,
+                    max_points=None):
         percentiles = {}
         for percentile_layer in models.PercentileLayer.objects.filter(
             layer_to_add_percentile_to=self.datasource_layer):
             source = datasource.get_datasource_by_layer(
                 percentile_layer.layer_to_get_percentile_from)
 
-            percentiles[percentile_layer.percentile] = source.timeseries(
-                location_id, start_datetime, end_datetime).data()
+            percentiles[percentile_layer.percentile] = (
+                source.timeseries_downsampled(
+                    location_id, start_datetime, end_datetime,
+                    max_points).data())
 
         return percentiles
 
     def expand(self, choices_made):
         return self.original_datasource.expand(choices_made)
 
+    def cache_script_delay(self):
+        return self.original_datasource.cache_script_delay()
+
 
 def factory():
     """Return an AugmentedDataSource object for each
@@ -243,6 +377,41 @@ def factory():
             for config_object in models.AugmentedDataSource.objects.all()]
 
 
+def _rd_points(locations):
+    """Return a list of the identifiers of the locations and an (n, 2)
+    array of their coordinates in RD, converted in one call. If an
+    identifier occurs more than once, its last location is used."""
+    if isinstance(locations, location.LocationSet):
+        identifiers = locations.identifiers
+        latitudes = locations.latitudes
+        longitudes = locations.longitudes
+    else:
+        identifiers = []
+        latitudes = array(b'd')
+        longitudes = array(b'd')
+        for point in locations:
+            identifiers.append(point.identifier)
+            latitudes.append(point.latitude)
+            longitudes.append(point.longitude)
+        latitudes = numpy.frombuffer(latitudes)
+        longitudes = numpy.frombuffer(longitudes)
+
+    if not len(identifiers):
+        return [], numpy.zeros((0, 2))
+
+    x, y = coordinates.wgs84_to_rd(latitudes, longitudes)
+    points = numpy.column_stack((x, y))
+
+    last = dict(
+        (identifier, i) for i, identifier in enumerate(identifiers))
+    if len(last) < len(identifiers):
+        keep = sorted(last.values())
+        identifiers = [identifiers[i] for i in keep]
+        points = points[keep]
+
+    return identifiers, points
+
+
 def fill_mapping_with_closest_locations(augmented_datasource_model):
     for extra_graph_line in (
         augmented_datasource_model.extragraphline_set.all()):
@@ -255,20 +424,17 @@ def fill_mapping_with_closest_locations(augmented_datasource_model):
         datasource_from = datasource.get_datasource_by_layer(
             extra_graph_line.layer_to_get_line_from)
 
-        location_dict_to = dict(
-            (l.identifier,
-             coordinates.wgs84_to_rd(l.latitude, l.longitude))
-            for l in datasource_to.locations())
-
-        location_dict_from = dict(
-            (l.identifier,
-             coordinates.wgs84_to_rd(l.latitude, l.longitude))
-            for l in datasource_from.locations())
+        identifiers_to, points_to = _rd_points(
+            datasource_to.locations(bare=True))
+        identifiers_from, points_from = _rd_points(
+            datasource_from.locations(bare=True))
 
         # To add data FROM layer X to another layer Y, we need to be
         # able to translate identifiers FROM layer Y TO layer X. So
         # it's right that from and to are reversed.
-        extra_graph_line.identifier_mapping.create_proximity_map(
-            identifiers_from=location_dict_to,
-            identifiers_to=location_dict_from,
+        extra_graph_line.identifier_mapping.create_proximity_map_from_points(
+            identifiers_from=identifiers_to,
+            points_from=points_to,
+            identifiers_to=identifiers_from,
+            points_to=points_from,
             max_distance=extra_graph_line.max_distance_for_mapping)
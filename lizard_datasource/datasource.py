@@ -4,13 +4,22 @@
 from __future__ import print_function, unicode_literals
 from __future__ import absolute_import, division
 
+import copy as copymodule
 import itertools
 import json as jsonmodule
 import logging
 import pkg_resources
+import threading
+import time
+
+from django.db.models import signals
 
 from lizard_datasource import models
 from lizard_datasource import criteria
+from lizard_datasource import snapshot
+from lizard_datasource import timeseries as timeseriesmodule
+from lizard_datasource import timeseries_cache
+from lizard_datasource.functools import LRUCache
 from lizard_datasource.functools import memoize
 
 logger = logging.getLogger(__name__)
@@ -122,6 +131,10 @@ class DataSource(object):
     a Lizard data source. Other data sources should subclass this one.
     """
 
+    # Answer chooseable_criteria() from the criteria snapshot made by
+    # the cache script, if there is one (see snapshot.py)
+    USE_CRITERIA_SNAPSHOT = True
+
     @property
     def identifier(self):
         return ''  # Only the base has the empty identifier
@@ -137,36 +150,55 @@ class DataSource(object):
     @property
     def datasource_model(self):
         if not hasattr(self, '_dsm') or not self._dsm:
-            try:
-                self._dsm = models.DatasourceModel.objects.get(
-                    identifier=self.identifier,
-                    originating_app=self.originating_app)
-            except models.DatasourceModel.DoesNotExist:
-                self._dsm = models.DatasourceModel(
-                    identifier=self.identifier,
-                    originating_app=self.originating_app)
-                self._dsm.save()
+            self._dsm = get_datasource_model(self)
         return self._dsm
 
     @property
     def visible(self):
         return self.datasource_model.visible
 
+    def copy(self):
+        """Return a copy of this datasource that can be given other
+        choices made without changing this one. The copy doesn't get
+        the options remembered by memoized_options_for_criterion()."""
+        datasource = copymodule.copy(self)
+        datasource._options_memo = None
+        # The instance this is a copy of, see get_datasource_by_model()
+        datasource._copied_from = self.copied_from
+        return datasource
+
+    @property
+    def copied_from(self):
+        """Return the datasource this one is a (copy of a) copy of, or
+        itself if it isn't a copy."""
+        return getattr(self, '_copied_from', None) or self
+
     @property
     def datasource_layer(self):
         """Return the DatasourceLayer model instance that relates to
         this datasource and the curently set ChoicesMade. Create the
         instance if it doesn't exist yet.
 
-        Should only be called on drawable datasources."""
+        Should only be called on drawable datasources. Each call
+        returns a new instance, so callers may change and save it."""
 
-        # Don't cache, because choices_made is mutated regularly.
+        # Don't cache on self, because choices_made is mutated
+        # regularly. There is a module-level cache instead.
         json = self.get_choices_made().json()
         dsm = self.datasource_model
 
-        dsl, created = models.DatasourceLayer.objects.get_or_create(
-            datasource_model=dsm, choices_made=json)
-        return dsl
+        key = (dsm.id, json)
+        dsl = _datasource_layers.get(key)
+        if dsl is None:
+            dsl, created = models.DatasourceLayer.objects.get_or_create(
+                datasource_model=dsm, choices_made=json)
+            _datasource_layers.set(key, dsl)
+
+        # Don't hand out the cached instance itself, changes to it
+        # would be seen by other callers before they are saved
+        layer = copymodule.copy(dsl)
+        layer._state = copymodule.copy(dsl._state)
+        return layer
 
     def activation_for_cache_script(self):
         """Return True if the cache script should active. If it shouldn't,
@@ -198,11 +230,41 @@ class DataSource(object):
 
         return criteria.EmptyOptions()
 
+    def memoized_options_for_criterion(self, criterion):
+        """Return options_for_criterion(criterion), remembered for as
+        long as the choices made stay the same. Use this instead of
+        calling options_for_criterion() directly, so that options
+        aren't computed several times while handling one request.
+
+        The functions that hand out datasources (get_datasources(),
+        get_datasource_by_model(), ...) return copies, which start
+        without remembered options."""
+        choices_json = (
+            self._choices_made.json()
+            if getattr(self, '_choices_made', None) is not None else None)
+        memo = getattr(self, '_options_memo', None)
+        if memo is None or memo[0] != choices_json:
+            # The choices changed, forget the old options
+            memo = self._options_memo = (choices_json, {})
+
+        options_by_criterion = memo[1]
+        if criterion.identifier not in options_by_criterion:
+            options_by_criterion[criterion.identifier] = (
+                self.options_for_criterion(criterion))
+        return options_by_criterion[criterion.identifier]
+
     def chooseable_criteria(self):
+        if self.USE_CRITERIA_SNAPSHOT:
+            criterions = snapshot.chooseable_criteria(self, self._choices_made)
+            if criterions is not None:
+                return criterions
+        return self._chooseable_criteria()
+
+    def _chooseable_criteria(self):
         all_criteria = self.criteria()
         chosen_identifiers = set()
         for criterion in all_criteria:
-            options = self.options_for_criterion(criterion)
+            options = self.memoized_options_for_criterion(criterion)
             if (criterion.identifier in self._choices_made or
                 len(options) == 1):
                 chosen_identifiers.add(criterion.identifier)
@@ -217,7 +279,7 @@ class DataSource(object):
                 # Not all prerequisites chosen
                 continue
 
-            options = self.options_for_criterion(criterion)
+            options = self.memoized_options_for_criterion(criterion)
             if len(options) > 1:
                 criterions.append({
                         'criterion': criterion,
@@ -267,6 +329,9 @@ class DataSource(object):
         Should return an Exception if the datasource is not LAYER_POINTS.
 
         Returns an iterable of lizard_datasource.location.Location objects.
+        Datasources with many locations can return a
+        lizard_datasource.location.LocationSet, which is such an
+        iterable too.
 
         If bare is False, other helpful information like coloring may
         be included in the locations. If bare is True, the fastest way
@@ -281,6 +346,88 @@ class DataSource(object):
         there are no timeseries available."""
         return None
 
+    def cached_timeseries(
+        self, location_id, start_datetime=None, end_datetime=None):
+        """Like timeseries(), but the result can come from the shared
+        timeseries cache (see timeseries_cache.py). Use this instead of
+        timeseries() itself."""
+        return timeseries_cache.cached_timeseries(
+            self, location_id, start_datetime, end_datetime)
+
+    def incremental_timeseries(
+        self, location_id, start_datetime=None, end_datetime=None):
+        """Like cached_timeseries(), but meant for graphs that are
+        refreshed: the timeseries fetched before is kept, and only the
+        part after its last timestamp is asked from timeseries()
+        again. See timeseries_cache.incremental_timeseries()."""
+        return timeseries_cache.incremental_timeseries(
+            self, location_id, start_datetime, end_datetime)
+
+    def lazy_timeseries(
+        self, location_id, start_datetime=None, end_datetime=None):
+        """Return a timeseries.LazyTimeseries that calls
+        cached_timeseries() only when its data is needed, and
+        timeseries_latest() for latest(). It uses a copy of this
+        datasource, so the choices made can't change in the
+        meantime."""
+        source = self.copy()
+        return timeseriesmodule.LazyTimeseries(
+            lambda start, end: source.cached_timeseries(
+                location_id, start, end),
+            start_datetime, end_datetime,
+            latest_loader=lambda start, end: source.timeseries_latest(
+                location_id, start, end))
+
+    def timeseries_latest(
+        self, location_id, start_datetime=None, end_datetime=None):
+        """Return the latest value of the timeseries at that location
+        id between the datetimes, like Timeseries.latest() does (a
+        pandas Series with one item), or None if this datasource can't
+        do that without getting the whole timeseries."""
+        return None
+
+    def timeseries_downsampled(
+        self, location_id, start_datetime=None, end_datetime=None,
+        max_points=None, method='lttb'):
+        """Like timeseries(), but each series in the result has at most
+        max_points points (if max_points is given), see
+        Timeseries.downsample(). Datasources whose backend can
+        downsample by itself can override this."""
+        result = self.cached_timeseries(
+            location_id, start_datetime, end_datetime)
+        if result is not None and max_points:
+            result = result.downsample(max_points, method)
+        return result
+
+    def timeseries_many(
+        self, location_ids, start_datetime=None, end_datetime=None,
+        max_points=None):
+        """Return the timeseries of several locations at once, as a
+        dictionary with the location ids as keys and the results of
+        timeseries() (a Timeseries object or None) as values. If
+        max_points is given, they are downsampled like
+        timeseries_downsampled() does.
+
+        By default this calls timeseries_downsampled() for each
+        location id, but datasources whose backend can answer for many
+        locations in one request should override it."""
+        return dict(
+            (location_id,
+             self.timeseries_downsampled(
+                    location_id, start_datetime, end_datetime, max_points))
+            for location_id in location_ids)
+
+    def latest_values(self):
+        """Return the latest value of each location in the current
+        layer, for datasources with DATA_CAN_HAVE_VALUE_LAYER.
+
+        The result is a pandas DataFrame indexed by location id, with
+        a 'timestamp' column (UTC datetimes) and a 'value' column.
+        Locations that have no value don't have to be in it. Returns
+        None if the datasource can't answer this in one go, so that the
+        timeseries of each location will have to be used instead."""
+        return None
+
     def location_annotations(self):
         """A datasource may add annotations (extra fields) to the
         Locations it returns.
@@ -321,6 +468,15 @@ class DataSource(object):
         it wants to."""
         return self.datasource_layer.unit_cache
 
+    def cache_script_delay(self):
+        """Return the number of seconds the cache_latest_values() script
+        should wait after each request for timeseries of this
+        datasource, or None if it doesn't have to wait.
+
+        Datasources whose backend can't handle many requests in quick
+        succession can override this."""
+        return None
+
 
 class CombinedDataSource(DataSource):
     """If there are several visible datasources in the system, a
@@ -339,6 +495,9 @@ class CombinedDataSource(DataSource):
     of datasources, so it has no config object in the database and does not
     by itself keep track of choices made.
     """
+    # There is no DatasourceModel to keep a snapshot for
+    USE_CRITERIA_SNAPSHOT = False
+
     def __init__(self, datasources):
         self._datasources = datasources
         self._choices_made = None
@@ -370,6 +529,12 @@ class CombinedDataSource(DataSource):
         """Should never be called."""
         raise ValueError()
 
+    def copy(self):
+        combined = super(CombinedDataSource, self).copy()
+        combined._datasources = [
+            datasource.copy() for datasource in self._datasources]
+        return combined
+
     def set_choices_made(self, choices_made):
         for datasource in self._datasources:
             datasource.set_choices_made(choices_made)
@@ -388,7 +553,8 @@ class CombinedDataSource(DataSource):
     def options_for_criterion(self, criterion):
         options = criteria.EmptyOptions()
         for ds in self._datasources:
-            options = options.add(ds.options_for_criterion(criterion))
+            options = options.add(
+                ds.memoized_options_for_criterion(criterion))
         return options
 
     # chooseable_criteria not overridden
@@ -445,13 +611,148 @@ def datasources_from_entrypoints():
     return datasources
 
 
+# Creating the datasources is expensive (the augmented datasource
+# factory queries the database), so the datasource instances are kept
+# in a registry. Each thread gets its own instances, because
+# datasources keep request state like the choices made. Threads
+# rebuild their registry when it's older than REGISTRY_MAX_AGE
+# seconds, or when the registry version changes because
+# invalidate_datasource_registry() was called.
+REGISTRY_MAX_AGE = 60
+
+_registry_lock = threading.Lock()
+_registry_version = 0
+_registry_local = threading.local()
+
+
+def invalidate_datasource_registry(**kwargs):
+    """Make all threads recreate their datasources the next time
+    they need them. Connected to the signals of the models that
+    datasource factories use, but other apps that have factories
+    using their own models should call it too when they change."""
+    global _registry_version
+    with _registry_lock:
+        _registry_version += 1
+
+
+def registered_datasources():
+    """Return the current thread's instances of all the datasources in
+    the system. See datasources_from_entrypoints()."""
+    version = _registry_version
+    now = time.time()
+
+    if (getattr(_registry_local, 'version', None) != version or
+        now - _registry_local.created > REGISTRY_MAX_AGE):
+        _registry_local.datasources = datasources_from_entrypoints()
+        _registry_local.by_model = None
+        _registry_local.datasource_models = None
+        _registry_local.version = version
+        _registry_local.created = now
+
+    return _registry_local.datasources
+
+
+def _datasources_by_model():
+    """Return a dictionary with (originating_app, identifier) tuples as
+    keys and lists of the current thread's datasources with that
+    originating app and identifier as values. Built once per registry."""
+    datasources = registered_datasources()
+
+    if _registry_local.by_model is None:
+        by_model = {}
+        for datasource in datasources:
+            key = (datasource.originating_app, datasource.identifier)
+            by_model.setdefault(key, []).append(datasource)
+        _registry_local.by_model = by_model
+
+    return _registry_local.by_model
+
+
+for sender in (models.DatasourceModel, models.AugmentedDataSource):
+    signals.post_save.connect(invalidate_datasource_registry, sender=sender)
+    signals.post_delete.connect(invalidate_datasource_registry, sender=sender)
+
+
+def _registered_datasource_models():
+    """Return a dictionary with (originating_app, identifier) tuples as
+    keys and DatasourceModel instances as values, for all the
+    registered datasources.
+
+    All rows are loaded with one query, and the rows that are missing
+    are created with one bulk insert. The result is kept until the
+    registry is rebuilt, which happens when a DatasourceModel is
+    saved."""
+    datasources = registered_datasources()
+
+    if _registry_local.datasource_models is None:
+        keys = set(
+            (datasource.originating_app, datasource.identifier)
+            for datasource in datasources)
+        datasource_models = {}
+        for dsm in models.DatasourceModel.objects.all():
+            datasource_models.setdefault(
+                (dsm.originating_app, dsm.identifier), dsm)
+
+        missing = keys - set(datasource_models)
+        if missing:
+            models.DatasourceModel.objects.bulk_create([
+                    models.DatasourceModel(
+                        originating_app=originating_app,
+                        identifier=identifier)
+                    for originating_app, identifier in missing])
+            # bulk_create doesn't set the primary keys, so get the
+            # new rows from the database
+            for dsm in models.DatasourceModel.objects.all():
+                datasource_models.setdefault(
+                    (dsm.originating_app, dsm.identifier), dsm)
+
+        _registry_local.datasource_models = datasource_models
+
+    return _registry_local.datasource_models
+
+
+def get_datasource_model(datasource):
+    """Return the DatasourceModel instance of this datasource. Create
+    it if it doesn't exist yet."""
+    key = (datasource.originating_app, datasource.identifier)
+
+    datasource_model = _registered_datasource_models().get(key)
+    if datasource_model is None:
+        # Not a registered datasource, look it up by itself
+        datasource_model, created = (
+            models.DatasourceModel.objects.get_or_create(
+                originating_app=datasource.originating_app,
+                identifier=datasource.identifier))
+    return datasource_model
+
+
+# DatasourceLayer instances, keyed by (datasource model id, choices
+# made JSON). Saving or deleting a layer removes it from here, the TTL
+# is for changes made by other processes.
+_datasource_layers = LRUCache(maxsize=1000, ttl=60)
+
+
+def _forget_datasource_layer(sender, instance, **kwargs):
+    _datasource_layers.pop(
+        (instance.datasource_model_id, instance.choices_made))
+
+
+signals.post_save.connect(
+    _forget_datasource_layer, sender=models.DatasourceLayer)
+signals.post_delete.connect(
+    _forget_datasource_layer, sender=models.DatasourceLayer)
+
+
 def get_datasources(choices_made=ChoicesMade()):
     """Return all the datasources defined by entrypoints that are
-    applicable to the given choices_made."""
+    applicable to the given choices_made. They are copies of the
+    current thread's datasources, so that callers can each have their
+    own choices made."""
 
     datasources = []
-    for datasource in datasources_from_entrypoints():
+    for datasource in registered_datasources():
         if datasource.visible and datasource.is_applicable(choices_made):
+            datasource = datasource.copy()
             datasource.set_choices_made(choices_made)
             datasources.append(datasource)
 
@@ -465,14 +766,18 @@ def get_datasource_by_model(datasource_model, exclude=None):
     property and an 'identifier' property. Datasource_models store these,
     plus some central configuration options for the datasources. If you
     have a datasource_model instance, use this function to get the
-    corresponding datasource."""
-    for datasource in datasources_from_entrypoints():
-        if exclude and datasource is exclude:
-            continue
+    corresponding datasource.
+
+    The result is a copy of the current thread's datasource, so that
+    setting choices made on it doesn't change it for other
+    callers. If exclude is given, the datasource it is (a copy of) is
+    skipped, and another one with the same key may be returned."""
+    key = (datasource_model.originating_app, datasource_model.identifier)
+    excluded = exclude.copied_from if exclude is not None else None
 
-        if (datasource_model.originating_app == datasource.originating_app
-            and datasource.identifier == datasource_model.identifier):
-            return datasource
+    for datasource in _datasources_by_model().get(key, ()):
+        if datasource is not excluded:
+            return datasource.copy()
 
 
 def get_datasource_by_layer(datasource_layer):
@@ -480,7 +785,8 @@ def get_datasource_by_layer(datasource_layer):
 
     A datasource layer is defined by a datasource model and a set of
     choices made. This function retrieves the datasource using the
-    datasource model, and sets the choices made before returning it."""
+    datasource model, and sets the choices made on it before returning
+    it."""
     datasource = get_datasource_by_model(
         datasource_layer.datasource_model)
 
@@ -126,28 +126,39 @@ class DummyDataSource(datasource.DataSource):
 
         return 'first_letter' in choices_made
 
-    def locations(self):
+    def locations(self, bare=True):
         if not self.is_drawable():
             raise ValueError(
                 "Datasource locations() called when it wasn't drawable")
         cities = CITIES[self._choices_made['first_letter']]
 
-        return [
-            location.Location(
-                identifier=city['id'],
-                latitude=city['lat'] / 1000000.0,
-                longitude=city['lon'] / 1000000.0)
+        return location.LocationSet(
+            identifiers=[city['id'] for city in cities],
+            latitudes=[city['lat'] / 1000000.0 for city in cities],
+            longitudes=[city['lon'] / 1000000.0 for city in cities])
 
-            for city in cities
-            ]
-
-    def timeseries(self, location_id, start_datetime=None, end_datetime=None):
-        return timeseries.Timeseries({
+    def _dummy_data(self):
+        return {
             utc(2012, 11, 13, 11, 0): 10.0,
             utc(2012, 11, 13, 12, 0): 15.0,
             utc(2012, 11, 13, 13, 0): 20.0,
             utc(2012, 11, 13, 14, 0): 14.0
-            })
+            }
+
+    def timeseries(self, location_id, start_datetime=None, end_datetime=None):
+        return timeseries.Timeseries(self._dummy_data())
+
+    def timeseries_many(
+        self, location_ids, start_datetime=None, end_datetime=None,
+        max_points=None):
+        # All locations have the same data, so build it only once
+        dummy = timeseries.Timeseries(self._dummy_data())
+        if max_points:
+            dummy = dummy.downsample(max_points)
+        dataframe = dummy.dataframe
+        return dict(
+            (location_id, timeseries.Timeseries(dataframe))
+            for location_id in location_ids)
 
 
 def factory():
@@ -4,22 +4,130 @@
 from __future__ import print_function, unicode_literals
 from __future__ import absolute_import, division
 
+from collections import OrderedDict
+from collections import namedtuple
 from functools import wraps
+import threading
+import time
 
 
-def memoize(f):
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+# Marks a missing cache item, as None can be a remembered result
+_MISSING = object()
+
+
+def memoize(f=None, maxsize=128, ttl=None):
     """Remember the results of function f and immediately return a
-    remembered result if it's called with the same arguments again."""
-    memo_cache = dict()
+    remembered result if it's called with the same arguments again.
+
+    Use it as @memoize, or as @memoize(maxsize=..., ttl=...) to
+    remember at most maxsize results (the least recently used are
+    forgotten first) for at most ttl seconds. A maxsize of None means
+    there is no limit. Keyword arguments can be given in any order.
+
+    The remembered results are kept in an LRUCache, so it can be used
+    from several threads (or greenlets, if threading is patched). F
+    isn't called while holding its lock, so two threads can call f
+    with the same arguments at the same time.
+
+    The decorated function has cache_info(), which returns a CacheInfo
+    (hits, misses, maxsize, currsize), and cache_clear()."""
+    if f is None:
+        return lambda f: memoize(f, maxsize=maxsize, ttl=ttl)
+
+    memo_cache = LRUCache(maxsize=maxsize, ttl=ttl)
+    stats = {'hits': 0, 'misses': 0}
+    stats_lock = threading.Lock()
 
     @wraps(f)
     def memoed(*args, **kwargs):
         # Construct a key to use in the memo_cache
-        key = (tuple(args), tuple(kwargs.items()))
+        key = (tuple(args), tuple(sorted(kwargs.items())))
+
+        result = memo_cache.get(key, _MISSING)
+        with stats_lock:
+            stats['hits' if result is not _MISSING else 'misses'] += 1
+
+        if result is _MISSING:
+            result = f(*args, **kwargs)
+            memo_cache.set(key, result)
 
-        if key not in memo_cache:
-            memo_cache[key] = f(*args, **kwargs)
+        return result
 
-        return memo_cache[key]
+    def cache_info():
+        with stats_lock:
+            return CacheInfo(
+                stats['hits'], stats['misses'], maxsize, len(memo_cache))
 
+    def cache_clear():
+        memo_cache.clear()
+        with stats_lock:
+            stats['hits'] = stats['misses'] = 0
+
+    memoed.cache_info = cache_info
+    memoed.cache_clear = cache_clear
     return memoed
+
+
+class LRUCache(object):
+    """A thread-safe dict-like cache that holds at most maxsize items,
+    and forgets the least recently used ones first, or any number of
+    items if maxsize is None. If ttl (in seconds) is given, items are
+    also forgotten when they are older than that. Set() can give an
+    item its own ttl."""
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> (time it expires, value)
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+
+            expires, value = self._items.pop(key)
+            if expires is not None and time.time() > expires:
+                return default
+
+            # Put it back at the end, as most recently used
+            self._items[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (
+                time.time() + ttl if ttl is not None else None, value)
+            while (self.maxsize is not None and
+                   len(self._items) > self.maxsize):
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                return self._items.pop(key)[1]
+            return default
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        """Return the number of items that get() would return, after
+        dropping the expired ones."""
+        with self._lock:
+            now = time.time()
+            expired = [
+                key for key, (expires, value) in self._items.items()
+                if expires is not None and now > expires]
+            for key in expired:
+                del self._items[key]
+            return len(self._items)
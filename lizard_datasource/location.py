@@ -1,8 +1,24 @@
-"""Module for the Location class. So what if that's Java-ish, it keeps
-modules reasonably short and readable."""
+"""Module for the Location and LocationSet classes. So what if that's
+Java-ish, it keeps modules reasonably short and readable."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import copy
+import json
+
+import numpy
+
+# Marks the rows of an extra column whose location didn't have that
+# key, as None can be a value
+_MISSING = object()
 
 
 class Location(object):
+    __slots__ = (
+        '_identifier', '_latitude', '_longitude', '_extra_args', 'color')
+
     def __init__(self, identifier, latitude, longitude, color=None, **kwargs):
         self._identifier = identifier
         self._latitude = latitude
@@ -43,3 +59,174 @@ class Location(object):
 
     def __repr__(self):
         return unicode(self)
+
+
+class LocationSet(object):
+    """A set of locations stored as columns instead of as Location
+    objects: a list of identifiers, arrays of latitudes and longitudes,
+    a list of colors and optionally extra columns (lists, like the
+    keyword arguments of Location). Datasources with many locations can
+    return one from locations(); iterating over it gives Location
+    objects that are views of a row, created when needed.
+
+    If the Location objects given to from_locations() have different
+    keyword arguments, each row only has the keys its location had."""
+
+    def __init__(
+        self, identifiers, latitudes, longitudes, colors=None, **columns):
+        self.identifiers = list(identifiers)
+        self.latitudes = numpy.asarray(latitudes, dtype=float)
+        self.longitudes = numpy.asarray(longitudes, dtype=float)
+        if colors is None:
+            colors = [None] * len(self.identifiers)
+        self.colors = colors
+        self.columns = dict(
+            (key, list(values)) for key, values in columns.items())
+
+    @classmethod
+    def from_locations(cls, locations):
+        """Return a LocationSet of the given Location objects."""
+        locations = list(locations)
+        columns = {}
+        for i, location in enumerate(locations):
+            for key, value in location._extra_args.items():
+                if key not in columns:
+                    columns[key] = [_MISSING] * len(locations)
+                columns[key][i] = value
+
+        return cls(
+            [location.identifier for location in locations],
+            [location.latitude for location in locations],
+            [location.longitude for location in locations],
+            colors=[location.color for location in locations],
+            **columns)
+
+    def with_colors(self, colors):
+        """Return a LocationSet with the same locations, colored with
+        colors (a sequence in the same order). The other columns are
+        shared with this set, not copied."""
+        location_set = copy.copy(self)
+        location_set.colors = list(colors)
+        return location_set
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return _LocationView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield _LocationView(self, index)
+
+    def to_dicts(self):
+        """Return the same as [location.to_dict() for location in self],
+        but without creating Location objects."""
+        keys = list(self.columns)
+        columns = [self.columns[key] for key in keys]
+        dicts = []
+        for i, (identifier, latitude, longitude, color) in enumerate(zip(
+                self.identifiers, self.latitudes.tolist(),
+                self.longitudes.tolist(), self.colors)):
+            d = dict((key, column[i]) for key, column in zip(keys, columns)
+                     if column[i] is not _MISSING)
+            d['identifier'] = identifier
+            d['latitude'] = latitude
+            d['longitude'] = longitude
+            if color is not None:
+                d['color'] = color
+            dicts.append(d)
+        return dicts
+
+    def iter_json(self):
+        """Yield the JSON of the list of location dicts (see
+        to_dicts()) in pieces, one per location. The coordinates are
+        converted to Python floats one whole column at a time."""
+        return self._iter_json(self._json_location)
+
+    def iter_geojson(self):
+        """Like iter_json(), but the pieces form a GeoJSON
+        FeatureCollection of points. The other fields of the locations
+        are the properties of the features."""
+        yield '{"type": "FeatureCollection", "features": '
+        for piece in self._iter_json(self._json_feature):
+            yield piece
+        yield '}'
+
+    def to_json(self):
+        return ''.join(self.iter_json())
+
+    def to_geojson(self):
+        return ''.join(self.iter_geojson())
+
+    def _iter_json(self, json_row):
+        dumps = json.dumps
+        keys = list(self.columns)
+        columns = [self.columns[key] for key in keys]
+        encoded_keys = [dumps(key) for key in keys]
+
+        yield '['
+        for i, (identifier, latitude, longitude, color) in enumerate(zip(
+                self.identifiers, self.latitudes.tolist(),
+                self.longitudes.tolist(), self.colors)):
+            properties = ['"identifier": ' + dumps(identifier)]
+            if color is not None:
+                properties.append('"color": ' + dumps(color))
+            properties.extend(
+                encoded_key + ': ' + dumps(column[i])
+                for encoded_key, column in zip(encoded_keys, columns)
+                if column[i] is not _MISSING)
+            yield (', ' if i else '') + json_row(
+                ', '.join(properties), repr(latitude), repr(longitude))
+        yield ']'
+
+    def _json_location(self, properties, latitude, longitude):
+        return '{{{0}, "latitude": {1}, "longitude": {2}}}'.format(
+            properties, latitude, longitude)
+
+    def _json_feature(self, properties, latitude, longitude):
+        return (
+            '{{"type": "Feature", "geometry": {{"type": "Point", '
+            '"coordinates": [{2}, {1}]}}, "properties": {{{0}}}}}'.format(
+                properties, latitude, longitude))
+
+
+class _LocationView(Location):
+    """A Location that reads its fields from a row of a LocationSet.
+    Setting its color changes the color in the set."""
+    __slots__ = ('_set', '_index')
+
+    def __init__(self, location_set, index):
+        self._set = location_set
+        self._index = index
+
+    @property
+    def _identifier(self):
+        return self._set.identifiers[self._index]
+
+    @property
+    def _latitude(self):
+        return float(self._set.latitudes[self._index])
+
+    @property
+    def _longitude(self):
+        return float(self._set.longitudes[self._index])
+
+    @property
+    def _extra_args(self):
+        return dict(
+            (key, column[self._index])
+            for key, column in self._set.columns.items()
+            if column[self._index] is not _MISSING)
+
+    @property
+    def color(self):
+        return self._set.colors[self._index]
+
+    @color.setter
+    def color(self, color):
+        self._set.colors[self._index] = color
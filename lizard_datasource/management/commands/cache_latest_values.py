@@ -9,6 +9,7 @@ from django.core.management.base import BaseCommand
 
 from lizard_datasource import datasource
 from lizard_datasource import scripts
+from lizard_datasource import snapshot
 
 logger = logging.getLogger(__name__)
 
@@ -18,7 +19,8 @@ class Command(BaseCommand):
     help = """Iterate over all data sources. If possible, retrieve the
     latest values of all timeseries in them, and cache them. This is
     helpful for things like colouring map layers, thresholding, and
-    similar functionality."""
+    similar functionality. Also refresh the snapshots of the criteria
+    of the data sources."""
 
     option_list = BaseCommand.option_list + (
         make_option('--no-cache',
@@ -26,13 +28,31 @@ class Command(BaseCommand):
                     action="store_true",
                     default=False,
                     help="Ignore lizard-datasource caching"),
+        make_option('--chunk-size',
+                    dest='chunk_size',
+                    type='int',
+                    default=scripts.DEFAULT_CHUNK_SIZE,
+                    help="Number of cached values to write per query"),
+        make_option('--workers',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help="Number of layers to cache in parallel"),
     )
 
     def handle(self, *args, **options):
         for ds in datasource.datasources_from_entrypoints():
             try:
                 scripts.cache_latest_values(
-                    ds, allow_cache=(options['no_cache'] == False))
+                    ds, allow_cache=(options['no_cache'] == False),
+                    chunk_size=options['chunk_size'],
+                    workers=options['workers'])
             except:
                 logger.exception(
                     'Exception for datasource {0}, skipping it'.format(ds))
+            try:
+                snapshot.refresh(ds)
+            except:
+                logger.exception(
+                    'Exception making the criteria snapshot of '
+                    'datasource {0}'.format(ds))
@@ -20,3 +20,15 @@ class TestCacheLatestValues(TestCase):
                 self.assertTrue(mocked1.called)
                 self.assertTrue(mocked2.called)
                 mocked2.assert_called_with(return_value[0])
+
+    def test_run_refreshes_snapshots(self):
+        command = cache_latest_values.Command()
+        return_value = [mock.MagicMock()]
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=return_value):
+            with mock.patch('lizard_datasource.scripts.cache_latest_values'):
+                with mock.patch('lizard_datasource.snapshot.refresh'
+                                ) as mocked:
+                    command.handle(no_cache=False, chunk_size=1, workers=1)
+                    mocked.assert_called_with(return_value[0])
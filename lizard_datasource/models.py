@@ -3,18 +3,46 @@ from __future__ import print_function, unicode_literals
 from __future__ import absolute_import, division
 
 import logging
-import math
+import threading
 
 from django.db import models
+from django.db import transaction
+from django.db.models import signals
 from django.utils.translation import ugettext_lazy as _
 import colorful.fields
+import numpy
 
 from lizard_datasource import dates
+from lizard_datasource import spatial
+from lizard_datasource.functools import LRUCache
 
 
 logger = logging.getLogger(__name__)
 
 
+def save_in_chunks(model_class, instances, fields, chunk_size=500):
+    """Write a list of new or changed instances of model_class to the
+    database, chunk_size instances per transaction.
+
+    New instances are inserted with bulk_create. Of instances that
+    already exist, only the given fields are updated, with one UPDATE
+    per row. Neither sends signals."""
+    for i in range(0, len(instances), chunk_size):
+        chunk = instances[i:i + chunk_size]
+        with transaction.atomic():
+            for instance in chunk:
+                if instance.pk is not None:
+                    model_class.objects.filter(pk=instance.pk).update(
+                        **dict((field, getattr(instance, field))
+                               for field in fields))
+            model_class.objects.bulk_create([
+                    instance for instance in chunk if instance.pk is None])
+
+
+# The fields of DatasourceModel that only the cache script changes
+SCRIPT_FIELDS = ('script_last_run_started', 'script_run_next_opportunity')
+
+
 class DatasourceModel(models.Model):
     """Each datasource we find should have a corresponding entry in
     this table. It controls whether the datasource should be visible
@@ -39,6 +67,13 @@ class DatasourceModel(models.Model):
     script_last_run_started = models.DateTimeField(null=True)
     script_run_next_opportunity = models.BooleanField(default=False)
 
+    # How long (in seconds) timeseries from this datasource may be
+    # cached, see timeseries_cache.py. 0 means not at all.
+    timeseries_cache_ttl = models.IntegerField(
+        default=0,
+        help_text=_("Seconds that timeseries from this datasource may be "
+                    "cached, 0 to not cache them."))
+
     def __unicode__(self):
         return "'{0}' from app '{1}'".format(
             self.identifier,
@@ -54,7 +89,7 @@ class DatasourceModel(models.Model):
         if self.cache_script_is_due():
             self.script_last_run_started = dates.utc_now()
             self.script_run_next_opportunity = False
-            self.save()
+            self.save(update_fields=SCRIPT_FIELDS)
             return True
         else:
             return False
@@ -182,6 +217,11 @@ class ColorMap(models.Model):
                 return color
         return self.defaultcolor
 
+    def compiled(self):
+        """Return a CompiledColorMap of this colormap, to find the
+        colors of many values at once."""
+        return CompiledColorMap(self)
+
     def legend(self):
         l = [
             (line.color, line.line_description)
@@ -192,6 +232,67 @@ class ColorMap(models.Model):
         return l
 
 
+class CompiledColorMap(object):
+    """The lines of a ColorMap, loaded once into NumPy arrays.
+
+    colors_for() gives the same results as calling ColorMap.color_for()
+    for each value, but classifies a whole array of values at once."""
+
+    def __init__(self, colormap):
+        # Lines without a color are skipped by ColorMap.color_for()
+        lines = [line for line in colormap.colormapline_set.all()
+                 if line.color]
+
+        self.has_min = numpy.array(
+            [line.minvalue is not None for line in lines], dtype=bool)
+        self.minvalues = numpy.array(
+            [line.minvalue if line.minvalue is not None else numpy.nan
+             for line in lines], dtype=float)
+        self.mininclusive = numpy.array(
+            [bool(line.mininclusive) for line in lines], dtype=bool)
+
+        self.has_max = numpy.array(
+            [line.maxvalue is not None for line in lines], dtype=bool)
+        self.maxvalues = numpy.array(
+            [line.maxvalue if line.maxvalue is not None else numpy.nan
+             for line in lines], dtype=float)
+        self.maxinclusive = numpy.array(
+            [bool(line.maxinclusive) for line in lines], dtype=bool)
+
+        # The last color is used if no line matches
+        self.colors = numpy.array(
+            [line.color for line in lines] + [colormap.defaultcolor],
+            dtype=object)
+
+    def colors_for(self, values):
+        """Return an array with the color for each of the values."""
+        values = numpy.asarray(values, dtype=float)
+        num_lines = len(self.colors) - 1
+        if num_lines == 0:
+            return self.colors[numpy.zeros(values.shape, dtype=int)]
+
+        # Arrays of shape (lines, values); open ends work as in
+        # ColorMapLine.color_for()
+        value = values[numpy.newaxis, :]
+        with numpy.errstate(invalid='ignore'):
+            minvalue = numpy.where(
+                self.has_min[:, numpy.newaxis],
+                self.minvalues[:, numpy.newaxis], value - 1)
+            maxvalue = numpy.where(
+                self.has_max[:, numpy.newaxis],
+                self.maxvalues[:, numpy.newaxis], value + 1)
+
+            matches = (
+                ((minvalue < value) & (value < maxvalue)) |
+                (self.mininclusive[:, numpy.newaxis] & (minvalue == value)) |
+                (self.maxinclusive[:, numpy.newaxis] & (maxvalue == value)))
+
+        # The first matching line wins
+        line_indices = numpy.where(
+            matches.any(axis=0), matches.argmax(axis=0), num_lines)
+        return self.colors[line_indices]
+
+
 class ColorFromLatestValue(models.Model):
     augmented_source = models.ForeignKey(AugmentedDataSource)
     layer_to_add_color_to = models.ForeignKey(
@@ -235,6 +336,14 @@ class ExtraGraphLine(models.Model):
         else:
             return self.identifier_mapping.map(identifier)
 
+    def map_identifiers(self, identifiers):
+        """Return a dict with the result of map_identifier() for each
+        identifier."""
+        if not self.identifier_mapping:
+            return dict((identifier, identifier) for identifier in identifiers)
+        else:
+            return self.identifier_mapping.map_many(identifiers)
+
 
 class ColorMapLine(models.Model):
     class Meta:
@@ -299,14 +408,31 @@ class IdentifierMapping(models.Model):
     name = models.CharField(
         max_length=30, null=False, blank=False, unique=True)
 
+    def lines(self):
+        """Return all lines of this mapping as a dict from
+        identifier_from to identifier_to. The dict is loaded with one
+        query and then kept in memory until a line of this mapping is
+        saved or deleted (or for a minute at most, for changes made by
+        other processes). Don't change it."""
+        version = _identifier_mapping_versions.get(self.id, 0)
+        cached = _identifier_mapping_lines.get(self.id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        lines = dict(IdentifierMappingLine.objects.filter(
+                mapping=self).values_list('identifier_from', 'identifier_to'))
+        _identifier_mapping_lines.set(self.id, (version, lines))
+        return lines
+
     def map(self, identifier):
-        try:
-            line = IdentifierMappingLine.objects.get(
-                mapping=self,
-                identifier_from=identifier)
-            return line.identifier_to
-        except IdentifierMappingLine.DoesNotExist:
-            return None
+        return self.lines().get(identifier)
+
+    def map_many(self, identifiers):
+        """Return a dict with the result of map() for each
+        identifier."""
+        lines = self.lines()
+        return dict(
+            (identifier, lines.get(identifier)) for identifier in identifiers)
 
     def map_to(self, identifier_from, identifier_to):
         line, created = IdentifierMappingLine.objects.get_or_create(
@@ -314,6 +440,33 @@ class IdentifierMapping(models.Model):
         line.identifier_to = identifier_to
         line.save()
 
+    def map_many_to(self, identifiers, chunk_size=500):
+        """Like calling map_to() for each item of identifiers, a dict
+        with identifiers_from as keys and identifiers_to as values,
+        but with a few bulk queries."""
+        existing = dict(
+            (line.identifier_from, line)
+            for line in IdentifierMappingLine.objects.filter(mapping=self))
+
+        lines = []
+        for identifier_from, identifier_to in identifiers.items():
+            line = existing.get(identifier_from)
+            if line is None:
+                lines.append(IdentifierMappingLine(
+                        mapping=self,
+                        identifier_from=identifier_from,
+                        identifier_to=identifier_to))
+            elif line.identifier_to != identifier_to:
+                line.identifier_to = identifier_to
+                lines.append(line)
+
+        with transaction.atomic():
+            save_in_chunks(
+                IdentifierMappingLine, lines, ('identifier_to',), chunk_size)
+
+        # Bulk_create and update() don't send signals
+        invalidate_identifier_mapping(self.id)
+
     def create_proximity_map(
         self, identifiers_from, identifiers_to, max_distance):
         """Identifiers_from and identifiers_to are dicts, with
@@ -324,23 +477,38 @@ class IdentifierMapping(models.Model):
 
         For each identifier in identifiers_from, calculate the point
         in identifiers_to that is closest to it, and add an
-        identifiermapping line for it."""
-        def distance(p1, p2):
-            return math.sqrt((p1[0] - p2[0]) ** 2 +
-                             (p1[1] - p2[1]) ** 2)
-
-        if not identifiers_to:
+        identifiermapping line for it. If several points are equally
+        close, the lowest identifier is used."""
+        self.create_proximity_map_from_points(
+            list(identifiers_from.keys()),
+            list(identifiers_from.values()),
+            list(identifiers_to.keys()),
+            list(identifiers_to.values()),
+            max_distance)
+
+    def create_proximity_map_from_points(
+        self, identifiers_from, points_from, identifiers_to, points_to,
+        max_distance):
+        """Like create_proximity_map(), but the identifiers are given
+        as lists and their points as (n, 2) arrays in the same order.
+        Identifiers should be unique."""
+        if not len(identifiers_to):
             return
 
-        for identifier, p1 in identifiers_from.items():
-            # Find closest point
-            mindistance, closest_identifier_to = min(
-                (distance(p1, p2), identifier_to)
-                for identifier_to, p2 in identifiers_to.items())
+        # Sorted, so that the grid index prefers the lowest identifier
+        points_to = numpy.asarray(points_to, dtype=float).reshape(-1, 2)
+        order = sorted(
+            range(len(identifiers_to)), key=identifiers_to.__getitem__)
+        index = spatial.GridIndex(points_to[order])
 
-            # If it is in range, map it
-            if not max_distance or mindistance <= max_distance:
-                self.map_to(identifier, closest_identifier_to)
+        mapping = {}
+        for identifier, p1 in zip(identifiers_from, points_from):
+            # Find closest point that is in range
+            closest, mindistance = index.nearest(p1, max_distance)
+            if closest is not None:
+                mapping[identifier] = identifiers_to[order[closest]]
+
+        self.map_many_to(mapping)
 
     def __unicode__(self):
         return self.name
@@ -357,3 +525,36 @@ class IdentifierMappingLine(models.Model):
 
     def __unicode__(self):
         return "{0} -> {1}".format(self.identifier_from, self.identifier_to)
+
+
+# Lines of identifier mappings, keyed on mapping id. The values are
+# (version, lines) tuples, a cached dict is only used if its version is
+# still the current version of the mapping.
+_identifier_mapping_lines = LRUCache(maxsize=100, ttl=60)
+_identifier_mapping_versions = {}
+_identifier_mapping_lock = threading.Lock()
+
+
+def invalidate_identifier_mapping(mapping_id):
+    """Make IdentifierMapping.lines() load the lines of this mapping
+    again."""
+    with _identifier_mapping_lock:
+        _identifier_mapping_versions[mapping_id] = (
+            _identifier_mapping_versions.get(mapping_id, 0) + 1)
+    _identifier_mapping_lines.pop(mapping_id)
+
+
+def _forget_identifier_mapping_line(sender, instance, **kwargs):
+    invalidate_identifier_mapping(instance.mapping_id)
+
+
+def _forget_identifier_mapping(sender, instance, **kwargs):
+    invalidate_identifier_mapping(instance.id)
+
+
+signals.post_save.connect(
+    _forget_identifier_mapping_line, sender=IdentifierMappingLine)
+signals.post_delete.connect(
+    _forget_identifier_mapping_line, sender=IdentifierMappingLine)
+signals.post_delete.connect(
+    _forget_identifier_mapping, sender=IdentifierMapping)
@@ -1,7 +1,13 @@
 import datetime
 import logging
+import threading
 import time
 
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+
+from django.db import connection
+
 from lizard_datasource import datasource
 from lizard_datasource import dates
 from lizard_datasource import models
@@ -9,11 +15,15 @@ from lizard_datasource import properties
 
 logger = logging.getLogger(__name__)
 
+# Number of DatasourceCache rows the cache script writes per query
+DEFAULT_CHUNK_SIZE = 500
 
-def _yield_drawable_datasources(ds):
+
+def _yield_drawable_choices_mades(ds):
     # This implements a breadth-first search that tries to visit all
     # drawable layers and yields their choices made objects. The case
     # where ChoicesMade is empty functions as the root of the tree.
+    # When a choices made object is yielded, it is also set on ds.
     choices_mades = [datasource.ChoicesMade()]
 
     while choices_mades:
@@ -21,7 +31,7 @@ def _yield_drawable_datasources(ds):
         ds.set_choices_made(choices_made)
 
         if ds.is_drawable(choices_made):
-            yield ds
+            yield choices_made
         else:
             criteria = ds.chooseable_criteria()
             # logger.debug("choices_made: %s", choices_made)
@@ -35,17 +45,235 @@ def _yield_drawable_datasources(ds):
                             criterion.identifier, option.identifier))
 
 
-def cache_latest_values(ds, allow_cache=True):
+def _yield_drawable_datasources(ds):
+    """Yield ds once for each drawable layer, with the choices made
+    of that layer set on it."""
+    for choices_made in _yield_drawable_choices_mades(ds):
+        yield ds
+
+
+def _chunks(sequence, chunk_size):
+    """Yield successive slices of at most chunk_size items."""
+    for i in range(0, len(sequence), chunk_size):
+        yield sequence[i:i + chunk_size]
+
+
+def _save_cache_rows(ds_caches, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write a list of new or changed DatasourceCache instances to the
+    database, at most chunk_size rows per query."""
+    models.save_in_chunks(
+        models.DatasourceCache, ds_caches, ('timestamp', 'value'), chunk_size)
+
+
+def _ds_cache(ds_caches, datasource_layer, locationid):
+    """Return the existing DatasourceCache for locationid, or a new,
+    unsaved one."""
+    ds_cache = ds_caches.get(locationid)
+    if ds_cache is None:
+        ds_cache = models.DatasourceCache(
+            datasource_layer=datasource_layer,
+            locationid=locationid)
+    return ds_cache
+
+
+def _changed_caches_from_latest_values(
+    latest_values, ds_caches, datasource_layer):
+    """Return the DatasourceCache instances that change because of
+    latest_values, a DataFrame as returned by
+    DataSource.latest_values()."""
+    latest_values = latest_values.dropna()
+
+    changed = []
+    for locationid, timestamp, value in izip(
+        latest_values.index,
+        latest_values['timestamp'],
+        latest_values['value']):
+        ds_cache = _ds_cache(ds_caches, datasource_layer, locationid)
+        if ds_cache.timestamp == timestamp and ds_cache.value == value:
+            continue
+
+        ds_cache.timestamp = timestamp
+        ds_cache.value = value
+        changed.append(ds_cache)
+
+    logger.info("Found %s new latest values for ds layer %s",
+                len(changed), datasource_layer)
+    return changed
+
+
+def _changed_caches_from_timeseries(
+    drawable, ds_caches, datasource_layer, allow_cache=True,
+    chunk_size=DEFAULT_CHUNK_SIZE):
+    """Return the DatasourceCache instances that change because of
+    new values in the timeseries of the drawable's locations.
+    Timeseries are requested chunk_size locations at a time."""
+    delay = drawable.cache_script_delay()
+    now = dates.utc_now()
+
+    changed = []
+    for locations in _chunks(list(drawable.locations()), chunk_size):
+        location_caches = [
+            (location,
+             _ds_cache(ds_caches, datasource_layer, location.identifier))
+            for location in locations]
+
+        # Ask for the timeseries of the whole chunk at once, starting
+        # at the oldest timestamp any of its locations needs.
+        start_datetime = min(
+            dates.to_utc(ds_cache.timestamp)
+            if ds_cache.timestamp and allow_cache
+            else now - datetime.timedelta(days=4)
+            for location, ds_cache in location_caches)
+
+        timeseries_dict = drawable.timeseries_many(
+            [location.identifier for location in locations],
+            start_datetime=start_datetime,
+            end_datetime=now)
+        if delay:
+            time.sleep(delay)
+
+        for location, ds_cache in location_caches:
+            timeseries = timeseries_dict.get(location.identifier)
+            if timeseries is None or len(timeseries) == 0:
+                logger.info("Didn't find new latest value for ds layer %s "
+                            "and location %s since %s",
+                            datasource_layer, location, start_datetime)
+                continue
+
+            latest = timeseries.latest()
+            timestamp = latest.keys()[0]
+            if (allow_cache and ds_cache.timestamp and
+                timestamp < dates.to_utc(ds_cache.timestamp)):
+                # Older than what we have, because the chunk started
+                # earlier than this location needed
+                continue
+
+            if (ds_cache.timestamp == timestamp and
+                ds_cache.value == latest[0]):
+                # Nothing new
+                continue
+
+            ds_cache.timestamp = timestamp
+            ds_cache.value = latest[0]
+            logger.info("Found new latest value for ds layer %s "
+                        "and location %s: %s",
+                        datasource_layer, location, latest[0])
+            changed.append(ds_cache)
+
+    return changed
+
+
+def _cache_layer(drawable, datasource_layer, allow_cache=True,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    """Find new latest values for all the locations of a drawable
+    datasource and store them in the DatasourceCache table of
+    datasource_layer.
+
+    Datasources with DATA_CAN_HAVE_VALUE_LAYER are asked for all the
+    latest values of the layer at once. If they don't have them, and
+    for other datasources, the timeseries of each location are asked
+    for, but only if the datasource has
+    DATA_CAN_HAVE_VALUE_LAYER_SCRIPT."""
+
+    # One query for all the values we already have
+    ds_caches = dict(
+        (ds_cache.locationid, ds_cache)
+        for ds_cache in models.DatasourceCache.objects.filter(
+            datasource_layer=datasource_layer))
+
+    latest_values = None
+    if drawable.has_property(properties.DATA_CAN_HAVE_VALUE_LAYER):
+        latest_values = drawable.latest_values()
+
+    if latest_values is not None:
+        changed = _changed_caches_from_latest_values(
+            latest_values, ds_caches, datasource_layer)
+    elif not drawable.has_property(
+        properties.DATA_CAN_HAVE_VALUE_LAYER_SCRIPT):
+        # Such datasources must not be crawled by this script
+        logger.info("No latest values for ds layer %s, skipping it",
+                    datasource_layer)
+        return
+    else:
+        changed = _changed_caches_from_timeseries(
+            drawable, ds_caches, datasource_layer, allow_cache, chunk_size)
+
+    _save_cache_rows(changed, chunk_size)
+
+
+def _cache_drawable(drawable, allow_cache=True,
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+    """Cache the latest values of the layer that drawable currently
+    represents."""
+    # This creates the datasource layer in the database, if it
+    # didn't exist yet
+    datasource_layer = drawable.datasource_layer
+
+    # Cache the datasource layer's unit, if it wasn't filled in yet
+    drawable.cached_unit()
+
+    # If we don't actually use the latest values of this layer, we
+    # should skip it.
+    if not datasource_layer.latest_values_used:
+        return
+
+    _cache_layer(drawable, datasource_layer, allow_cache, chunk_size)
+
+
+# Datasource instances of the worker threads, see _worker_datasource()
+_worker_local = threading.local()
+
+
+def _worker_datasource(datasource_model):
+    """Return the datasource of datasource_model that belongs to the
+    current worker thread.
+
+    Datasources keep their choices made as state, so worker threads
+    can't share datasource instances with each other or with the
+    thread that walks the criteria tree."""
+    if not hasattr(_worker_local, 'datasources'):
+        _worker_local.datasources = {}
+
+    if datasource_model.id not in _worker_local.datasources:
+        _worker_local.datasources[datasource_model.id] = (
+            datasource.get_datasource_by_model(datasource_model))
+    return _worker_local.datasources[datasource_model.id]
+
+
+def _cache_choices_made_in_worker(args):
+    """Run by the worker threads of cache_latest_values()."""
+    datasource_model, choices_made, allow_cache, chunk_size = args
+    try:
+        drawable = _worker_datasource(datasource_model)
+        drawable.set_choices_made(choices_made)
+        _cache_drawable(drawable, allow_cache, chunk_size)
+    finally:
+        # Each thread has its own database connection
+        connection.close()
+
+
+def cache_latest_values(ds, allow_cache=True, chunk_size=DEFAULT_CHUNK_SIZE,
+                        workers=1):
     """IF the datasource has both LAYER_POINTS and
     DATA_CAN_HAVE_VALUE_LAYER_SCRIPT source, then we can make an
     instance of DatasourceLayer for each of its layers, get a
     timeseries for each location in each layer and cache its latest
     value. Then this information can be used for colouring,
-    thresholding, et cetera."""
+    thresholding, et cetera.
+
+    If it has DATA_CAN_HAVE_VALUE_LAYER, it can give us the latest
+    values of each layer directly, and that is used instead.
+
+    The cached values of a layer are written to the database
+    chunk_size rows at a time.
+
+    If workers is more than 1, the layers are found first and then
+    cached by that many threads in parallel, each with its own
+    instance of the datasource."""
 
     if (not ds.has_property(properties.LAYER_POINTS) or
-        not ds.has_property(
-            properties.DATA_CAN_HAVE_VALUE_LAYER_SCRIPT)):
+        not (ds.has_property(properties.DATA_CAN_HAVE_VALUE_LAYER) or
+             ds.has_property(properties.DATA_CAN_HAVE_VALUE_LAYER_SCRIPT))):
         return  # For now, we don't know what to do in this case
 
     # Only actually do something if the script is due.
@@ -55,50 +283,18 @@ def cache_latest_values(ds, allow_cache=True):
         return
     logger.info("Caching latest values for datasource %s", ds)
 
-    for drawable in _yield_drawable_datasources(ds):
-        # This creates the datasource layer in the database, if it
-        # didn't exist yet
-        datasource_layer = drawable.datasource_layer
+    if workers <= 1:
+        for drawable in _yield_drawable_datasources(ds):
+            _cache_drawable(drawable, allow_cache, chunk_size)
+        return
 
-        # Cache the datasource layer's unit, if it wasn't filled in yet
-        drawable.cached_unit()
+    datasource_model = ds.datasource_model
+    tasks = [
+        (datasource_model, choices_made, allow_cache, chunk_size)
+        for choices_made in _yield_drawable_choices_mades(ds)]
 
-        # If we don't actually use the latest values of this layer, we
-        # should skip it.
-        if not datasource_layer.latest_values_used:
-            continue
-
-        locations = drawable.locations()
-        for location in locations:
-            try:
-                ds_cache = models.DatasourceCache.objects.get(
-                    datasource_layer=datasource_layer,
-                    locationid=location.identifier)
-            except models.DatasourceCache.DoesNotExist:
-                ds_cache = models.DatasourceCache(
-                    datasource_layer=datasource_layer,
-                    locationid=location.identifier)
-
-            if ds_cache.timestamp and allow_cache:
-                start_datetime = ds_cache.timestamp
-            else:
-                start_datetime = dates.utc_now() - datetime.timedelta(days=4)
-
-            timeseries = drawable.timeseries(
-                location.identifier,
-                start_datetime=start_datetime,
-                end_datetime=dates.utc_now())
-            if timeseries is None or len(timeseries) == 0:
-                logger.info("Didn't find new latest value for ds layer %s "
-                            "and location %s since %s",
-                            datasource_layer, location, start_datetime)
-                continue
-
-            latest = timeseries.latest()
-            ds_cache.timestamp = latest.keys()[0]
-            ds_cache.value = latest[0]
-            logger.info("Found new latest value for ds layer %s "
-                        "and location %s: %s",
-                            datasource_layer, location, latest[0])
-            ds_cache.save()
-            time.sleep(1)
+    pool = ThreadPool(workers)
+    try:
+        pool.map(_cache_choices_made_in_worker, tasks, chunksize=1)
+    finally:
+        pool.terminate()
@@ -0,0 +1,312 @@
+"""Snapshots of the criteria tree of a datasource.
+
+Rendering the facets of a datasource calls chooseable_criteria(), which
+asks the datasource for the options of every criterion and whether
+some choices are drawable. For remote datasources (FEWS) each of those
+can be a query. A snapshot walks the tree of choices once, like the
+cache script does, and stores the chooseable criteria of every
+ChoicesMade it visited. DataSource.chooseable_criteria() answers from
+the snapshot when it has one for the current choices, and falls back
+to asking the datasource otherwise.
+
+Snapshots are built by the cache_latest_values command and kept in
+Django's default cache as JSON, so that all processes can use
+them. Each process keeps the ones it read for a minute."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+from collections import deque
+import json
+import logging
+import threading
+import time
+
+from django.core.cache import get_cache
+from django.db.models import signals
+
+from lizard_datasource import criteria
+from lizard_datasource import models
+from lizard_datasource.functools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+# refresh() doesn't build a new snapshot if the one in the cache is
+# younger than this many seconds
+MAX_AGE = 60 * 60
+
+# Seconds Django's cache keeps a snapshot, so that a datasource that
+# isn't refreshed anymore stops using its old one
+TIMEOUT = 24 * 60 * 60
+
+# Stop walking the tree after this many ChoicesMade, the rest will be
+# computed by the datasource itself
+MAX_NODES = 10000
+
+DATATYPES = {
+    'select': criteria.Criterion.TYPE_SELECT,
+    'tree': criteria.Criterion.TYPE_TREE,
+    }
+
+# Snapshots (or None if there is none) read in this process, by
+# datasource model id
+_snapshots = LRUCache(maxsize=100, ttl=60)
+
+# Lookups are switched off in threads that are building a snapshot
+_building = threading.local()
+
+
+def cache_key(dsm_id):
+    return 'lizard_datasource.criteria_snapshot.{0}'.format(dsm_id)
+
+
+def _criterion_to_dict(criterion):
+    if criterion.datatype is criteria.Criterion.TYPE_TREE:
+        datatype = 'tree'
+    else:
+        datatype = 'select'
+    return {
+        'identifier': criterion.identifier,
+        'description': criterion.description,
+        'datatype': datatype,
+        'prerequisites': list(criterion.prerequisites),
+        }
+
+
+def _criterion_from_dict(d):
+    return criteria.Criterion(
+        d['identifier'], d['description'],
+        datatype=DATATYPES[d['datatype']],
+        prerequisites=tuple(d['prerequisites']))
+
+
+def _option_tree_to_dict(tree):
+    if tree.is_leaf:
+        return {'option': [tree.option.identifier, tree.option.description]}
+    return {
+        'description': tree.description,
+        'children': [_option_tree_to_dict(child) for child in tree.children],
+        }
+
+
+def _option_tree_from_dict(d):
+    if 'option' in d:
+        return criteria.OptionTree(option=criteria.Option(*d['option']))
+    return criteria.OptionTree(
+        description=d['description'],
+        children=[_option_tree_from_dict(child) for child in d['children']])
+
+
+def _options_to_dict(options):
+    """Return a dict for options, or raise TypeError for an Options
+    class that snapshots don't know."""
+    if isinstance(options, criteria.EmptyOptions):
+        return {'type': 'empty'}
+    if isinstance(options, criteria.OptionList):
+        return {
+            'type': 'list',
+            'options': sorted(
+                [option.identifier, option.description]
+                for option in options.options),
+            }
+    if isinstance(options, criteria.OptionTree):
+        return {'type': 'tree', 'tree': _option_tree_to_dict(options)}
+    raise TypeError("Can't put {0} in a snapshot.".format(options))
+
+
+def _options_from_dict(d):
+    if d['type'] == 'empty':
+        return criteria.EmptyOptions()
+    if d['type'] == 'list':
+        return criteria.OptionList(
+            criteria.Option(identifier, description)
+            for identifier, description in d['options'])
+    return _option_tree_from_dict(d['tree'])
+
+
+class Snapshot(object):
+    """The chooseable criteria of a datasource for each ChoicesMade
+    visited while building the snapshot, by the JSON of the
+    ChoicesMade."""
+
+    def __init__(self, nodes, created=None):
+        # Nodes are {'drawable': bool, 'criteria': [{'criterion': ...,
+        # 'options': ...}]} with the criteria and options as dicts,
+        # or None for criteria that couldn't be put in a snapshot
+        self.nodes = nodes
+        self.created = time.time() if created is None else created
+
+    @classmethod
+    def build(cls, ds, max_nodes=MAX_NODES):
+        """Walk the tree of choices of ds breadth first, following the
+        options of every chooseable criterion, and record what
+        chooseable_criteria() returns at each of them. Works on a copy
+        of ds."""
+        # The datasource module imports this one
+        from lizard_datasource.datasource import ChoicesMade
+
+        ds = ds.copy()
+        nodes = {}
+        root = ChoicesMade()
+        choices_mades = deque([root])
+        # The same choices can be reached in any order, queue them
+        # once, and never queue more than we will visit
+        seen = set([root.json()])
+
+        _building.active = True
+        try:
+            while choices_mades and len(nodes) < max_nodes:
+                choices_made = choices_mades.popleft()
+                key = choices_made.json()
+
+                ds.set_choices_made(choices_made)
+                drawable = bool(ds.is_drawable(choices_made))
+                chooseable = ds.chooseable_criteria()
+
+                try:
+                    serialized = [{
+                            'criterion': _criterion_to_dict(
+                                chooseable_criterion['criterion']),
+                            'options': _options_to_dict(
+                                chooseable_criterion['options']),
+                            } for chooseable_criterion in chooseable]
+                except TypeError:
+                    logger.debug(
+                        "Leaving %s out of the snapshot of %s",
+                        choices_made, ds.identifier)
+                    serialized = None
+
+                nodes[key] = {'drawable': drawable, 'criteria': serialized}
+
+                if not drawable:
+                    for chooseable_criterion in chooseable:
+                        identifier = chooseable_criterion['criterion'].identifier
+                        for option in (
+                                chooseable_criterion['options'].iter_options()):
+                            child = choices_made.add(
+                                identifier, option.identifier)
+                            child_key = child.json()
+                            if (child_key not in seen and
+                                len(seen) < max_nodes):
+                                seen.add(child_key)
+                                choices_mades.append(child)
+        finally:
+            _building.active = False
+
+        return cls(nodes)
+
+    def to_json(self):
+        return json.dumps({
+                'version': VERSION,
+                'created': self.created,
+                'nodes': self.nodes,
+                })
+
+    @classmethod
+    def from_json(cls, text):
+        """Return a Snapshot, or None if text was made by another
+        version of this module."""
+        d = json.loads(text)
+        if d.get('version') != VERSION:
+            return None
+        return cls(d['nodes'], created=d['created'])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def chooseable_criteria(self, choices_made):
+        """Return what ds.chooseable_criteria() returned for these
+        choices when the snapshot was built, or None if the snapshot
+        doesn't know."""
+        node = self.nodes.get(choices_made.json())
+        if node is None or node['criteria'] is None:
+            return None
+        return [{
+                'criterion': _criterion_from_dict(d['criterion']),
+                'options': _options_from_dict(d['options']),
+                } for d in node['criteria']]
+
+
+def get_snapshot(ds):
+    """Return the Snapshot of ds, or None."""
+    dsm_id = ds.datasource_model.id
+    snapshot = _snapshots.get(dsm_id, False)
+    if snapshot is False:
+        text = get_cache('default').get(cache_key(dsm_id))
+        snapshot = Snapshot.from_json(text) if text else None
+        _snapshots.set(dsm_id, snapshot)
+    return snapshot
+
+
+def chooseable_criteria(ds, choices_made):
+    """Return the chooseable criteria of ds for choices_made from its
+    snapshot, or None if they have to be computed."""
+    if getattr(_building, 'active', False):
+        return None
+    snapshot = get_snapshot(ds)
+    if snapshot is None:
+        return None
+    return snapshot.chooseable_criteria(choices_made)
+
+
+def refresh(ds, max_age=MAX_AGE, max_nodes=MAX_NODES):
+    """Build and store a new snapshot of ds, unless the stored one is
+    younger than max_age seconds. Return the snapshot, or None for
+    datasources that don't use snapshots."""
+    if not ds.USE_CRITERIA_SNAPSHOT:
+        return None
+
+    snapshot = get_snapshot(ds)
+    if snapshot is not None and time.time() - snapshot.created < max_age:
+        return snapshot
+
+    snapshot = Snapshot.build(ds, max_nodes=max_nodes)
+    dsm_id = ds.datasource_model.id
+    get_cache('default').set(cache_key(dsm_id), snapshot.to_json(), TIMEOUT)
+    _snapshots.set(dsm_id, snapshot)
+    logger.info(
+        "Built a criteria snapshot of %s with %d nodes",
+        ds.identifier, len(snapshot))
+    return snapshot
+
+
+def forget_model(dsm_id):
+    """Remove the snapshot of the datasource of the DatasourceModel
+    with this id, from this process and the cache."""
+    _snapshots.pop(dsm_id)
+    get_cache('default').delete(cache_key(dsm_id))
+
+
+def forget(ds):
+    """Remove the snapshot of ds, from this process and the cache."""
+    forget_model(ds.datasource_model.id)
+
+
+def _forget_datasource_model(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= set(models.SCRIPT_FIELDS):
+        # Just the cache script recording that it ran
+        return
+    forget_model(instance.id)
+
+
+def _forget_augmented_source(sender, instance, **kwargs):
+    """Forget the snapshots of the datasources that a
+    ColorFromLatestValue or PercentileLayer relates to, so that admin
+    changes are seen at once."""
+    dsm_ids = set([instance.augmented_source.augmented_source_id])
+    for field in instance._meta.fields:
+        if field.rel and field.rel.to is models.DatasourceLayer:
+            layer = getattr(instance, field.name, None)
+            if layer is not None:
+                dsm_ids.add(layer.datasource_model_id)
+    for dsm_id in dsm_ids:
+        forget_model(dsm_id)
+
+
+for signal in (signals.post_save, signals.post_delete):
+    signal.connect(_forget_datasource_model, sender=models.DatasourceModel)
+    for sender in (models.ColorFromLatestValue, models.PercentileLayer):
+        signal.connect(_forget_augmented_source, sender=sender)
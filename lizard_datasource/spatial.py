@@ -0,0 +1,108 @@
+"""Nearest neighbour search for points in a plane, for instance in RD
+coordinates. Used to map the locations of one layer to those of
+another."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import math
+
+import numpy
+
+
+class GridIndex(object):
+    """Puts points in square grid cells, so that the nearest point to
+    some other point can be found by only looking at the cells around
+    it, instead of at all the points.
+
+    Distances are computed like sqrt((X1-X2)**2+(Y1-Y2)**2). If
+    several points are equally close, the one that came first in the
+    points passed to the constructor is returned."""
+
+    def __init__(self, points):
+        """Points is a sequence of (X, Y) tuples or an array of shape
+        (n, 2)."""
+        self.points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+
+        if len(self.points):
+            self.minimum = self.points.min(axis=0)
+            size = (self.points.max(axis=0) - self.minimum).max()
+            # Aim for about one point per cell
+            self.cellsize = (size / math.sqrt(len(self.points))) or 1.0
+        else:
+            self.minimum = numpy.zeros(2)
+            self.cellsize = 1.0
+
+        cells = self._cells(self.points)
+        self.gridsize = cells.max(axis=0) + 1 if len(cells) else (0, 0)
+
+        # Map each cell to the indices of its points, in order
+        self.cells = {}
+        for i, cell in enumerate(cells.tolist()):
+            self.cells.setdefault(tuple(cell), []).append(i)
+        for cell, indices in self.cells.items():
+            self.cells[cell] = numpy.array(indices, dtype=int)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cells(self, points):
+        return numpy.floor(
+            (points - self.minimum) / self.cellsize).astype(int)
+
+    def _indices_in_block(self, cx, cy, k):
+        """Return the indices of the points in the cells at most k
+        cells away from cell (cx, cy)."""
+        blocks = [
+            self.cells[(ix, iy)]
+            for ix in range(max(cx - k, 0), min(cx + k + 1, self.gridsize[0]))
+            for iy in range(max(cy - k, 0), min(cy + k + 1, self.gridsize[1]))
+            if (ix, iy) in self.cells]
+        if not blocks:
+            return numpy.zeros(0, dtype=int)
+        return numpy.concatenate(blocks)
+
+    def nearest(self, point, max_distance=None):
+        """Return (index, distance) of the point closest to point, or
+        (None, None) if there are no points, or none of them is at
+        most max_distance away."""
+        if not len(self.points):
+            return None, None
+
+        x, y = float(point[0]), float(point[1])
+        cx, cy = self._cells(numpy.array([x, y]))
+
+        # Start at the first ring of cells that overlaps the grid
+        k = max(-cx, cx - self.gridsize[0] + 1,
+                -cy, cy - self.gridsize[1] + 1, 0)
+
+        while True:
+            indices = self._indices_in_block(cx, cy, k)
+            covers_grid = (
+                cx - k <= 0 and cy - k <= 0 and
+                cx + k >= self.gridsize[0] - 1 and
+                cy + k >= self.gridsize[1] - 1)
+
+            if len(indices):
+                candidates = self.points[indices]
+                distances = numpy.sqrt(
+                    (x - candidates[:, 0]) ** 2 +
+                    (y - candidates[:, 1]) ** 2)
+                mindistance = distances.min()
+
+                # Points outside the block are at least k cells away,
+                # so if we found something closer we are done. A point
+                # at exactly that distance could tie with one outside
+                # the block that comes first, so then look further.
+                if mindistance < k * self.cellsize or covers_grid:
+                    if max_distance and mindistance > max_distance:
+                        return None, None
+                    index = indices[distances == mindistance].min()
+                    return int(index), float(mindistance)
+
+            if covers_grid:
+                return None, None
+            if max_distance and k * self.cellsize > max_distance:
+                return None, None
+            k += 1
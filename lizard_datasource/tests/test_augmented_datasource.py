@@ -5,6 +5,12 @@ import mock
 from django.test import TestCase
 
 from lizard_datasource import augmented_datasource
+from lizard_datasource import datasource
+from lizard_datasource import dates
+from lizard_datasource import dummy_datasource
+from lizard_datasource import location
+from lizard_datasource import models
+from lizard_datasource import timeseries
 from lizard_datasource.tests import test_models
 
 
@@ -23,3 +29,163 @@ class TestAugmentedSourceFactory(TestCase):
         test_models.AugmentedDataSourceF.create()
         sources = augmented_datasource.factory()
         self.assertEquals(len(sources), 1)
+
+
+class TestLocationColors(TestCase):
+    def setUp(self):
+        self.source = augmented_datasource.AugmentedDataSource(
+            test_models.AugmentedDataSourceF.create())
+        self.source._original_datasource = (
+            dummy_datasource.DummyDataSource())
+        self.source.set_choices_made(
+            datasource.ChoicesMade(first_letter='ae'))
+
+        colormap = test_models.ColorMapF.create(defaultcolor="#00ff00")
+        test_models.ColorMapLineF.create(
+            minvalue=0, maxvalue=10, color="#ff0000", colormap=colormap)
+
+        layer_from = test_models.DatasourceLayerF.create(choices_made="{}")
+        test_models.ColorFromLatestValueF.create(
+            augmented_source=self.source.config_object,
+            layer_to_add_color_to=self.source.datasource_layer,
+            layer_to_get_color_from=layer_from,
+            colormap=colormap)
+
+        for locationid, value in (('almere', 5.0), ('breda', 50.0)):
+            models.DatasourceCache.objects.create(
+                datasource_layer=layer_from, locationid=locationid,
+                timestamp=dates.utc(2012, 11, 13, 11, 0), value=value)
+
+    def test_locations_are_colored_by_cached_values(self):
+        colors = dict(
+            (location.identifier, location.color)
+            for location in self.source.locations())
+        self.assertEquals(colors['almere'], 'ff0000')
+        self.assertEquals(colors['breda'], '00ff00')
+        self.assertEquals(colors['delft'], '888888')
+
+    def test_locations_are_colored_in_chunks(self):
+        # Not a LocationSet, those are colored at once
+        original_locations = [
+            location.Location(l.identifier, l.latitude, l.longitude)
+            for l in self.source.original_datasource.locations()]
+        with mock.patch.object(
+            self.source.original_datasource, 'locations',
+            return_value=original_locations):
+            with mock.patch(
+                'lizard_datasource.augmented_datasource.COLOR_CHUNK_SIZE', 5):
+                locations = list(self.source.locations())
+        self.assertEquals(len(locations), len(dummy_datasource.CITIES['ae']))
+        self.assertTrue(all(location.color for location in locations))
+
+    def test_location_set_is_colored_as_a_copy(self):
+        location_set = self.source.original_datasource.locations()
+        with mock.patch.object(
+            self.source.original_datasource, 'locations',
+            return_value=location_set):
+            colors = [l.color for l in self.source.locations()]
+        self.assertTrue(all(colors))
+        self.assertFalse(any(location_set.colors))
+
+    def test_location_colors_returns_parallel_array(self):
+        colors = self.source.location_colors(['delft', 'almere'])
+        self.assertEquals(list(colors), ['888888', 'ff0000'])
+
+
+class TestTimeseries(TestCase):
+    def setUp(self):
+        self.source = augmented_datasource.AugmentedDataSource(
+            test_models.AugmentedDataSourceF.create())
+        self.source._original_datasource = (
+            dummy_datasource.DummyDataSource())
+        self.source.set_choices_made(
+            datasource.ChoicesMade(first_letter='ae'))
+
+    def test_max_points_is_passed_to_original_datasource(self):
+        with mock.patch.object(
+            self.source.original_datasource, 'timeseries_many',
+            return_value={'almere': None}) as mocked:
+            self.source.timeseries('almere', max_points=100)
+        mocked.assert_called_with(['almere'], None, None, max_points=100)
+
+    def test_max_points_isnt_passed_if_not_set(self):
+        # Like a datasource that overrides timeseries_many() without it
+        with mock.patch.object(
+            self.source.original_datasource, 'timeseries_many',
+            side_effect=lambda location_ids, start, end: {
+                'almere': None}) as mocked:
+            self.assertEquals(self.source.timeseries('almere'), None)
+        mocked.assert_called_with(['almere'], None, None)
+
+    def test_extra_graph_lines_are_merged(self):
+        for i in range(2):
+            models.ExtraGraphLine.objects.create(
+                augmented_source=self.source.config_object,
+                layer_to_add_line_to=self.source.datasource_layer,
+                layer_to_get_line_from=test_models.DatasourceLayerF.create(
+                    choices_made="{}"))
+
+        with mock.patch(
+            'lizard_datasource.datasource.get_datasource_by_layer',
+            return_value=dummy_datasource.DummyDataSource()):
+            result = self.source.timeseries('almere')
+
+        self.assertEquals(len(result.columns), 3)
+        self.assertEquals(len(result), 4)
+
+    def test_empty_timeseries_with_extra_graph_line(self):
+        models.ExtraGraphLine.objects.create(
+            augmented_source=self.source.config_object,
+            layer_to_add_line_to=self.source.datasource_layer,
+            layer_to_get_line_from=test_models.DatasourceLayerF.create(
+                choices_made="{}"))
+
+        with mock.patch.object(
+            self.source.original_datasource, 'timeseries_many',
+            return_value={'almere': timeseries.Timeseries({})}):
+            with mock.patch(
+                'lizard_datasource.datasource.get_datasource_by_layer',
+                return_value=dummy_datasource.DummyDataSource()):
+                result = self.source.timeseries('almere')
+
+        self.assertEquals(len(result.columns), 2)
+        self.assertEquals(len(result), 4)
+        self.assertEquals(result.values(), [])
+
+    def test_timeseries_downsampled(self):
+        result = self.source.timeseries_downsampled('almere', max_points=3)
+        self.assertEquals(len(result.timeseries), 3)
+
+
+class TestRdPoints(TestCase):
+    def test_converts_all_points_in_one_call(self):
+        locations = [
+            location.Location("a", 52.0, 5.0),
+            location.Location("b", 53.0, 6.0)]
+        with mock.patch(
+            'lizard_map.coordinates.wgs84_to_rd',
+            side_effect=lambda x, y: (x * 2, y * 3)) as patched:
+            identifiers, points = augmented_datasource._rd_points(
+                iter(locations))
+
+        self.assertEquals(patched.call_count, 1)
+        self.assertEquals(identifiers, ["a", "b"])
+        self.assertEquals(points.tolist(), [[104.0, 15.0], [106.0, 18.0]])
+
+    def test_last_location_of_identifier_is_used(self):
+        locations = [
+            location.Location("a", 52.0, 5.0),
+            location.Location("b", 53.0, 6.0),
+            location.Location("a", 54.0, 7.0)]
+        with mock.patch(
+            'lizard_map.coordinates.wgs84_to_rd',
+            side_effect=lambda x, y: (x, y)):
+            identifiers, points = augmented_datasource._rd_points(locations)
+
+        self.assertEquals(identifiers, ["b", "a"])
+        self.assertEquals(points.tolist(), [[53.0, 6.0], [54.0, 7.0]])
+
+    def test_no_locations(self):
+        identifiers, points = augmented_datasource._rd_points([])
+        self.assertEquals(identifiers, [])
+        self.assertEquals(points.shape, (0, 2))
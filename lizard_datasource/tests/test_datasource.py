@@ -1,10 +1,15 @@
 import mock
+import threading
 
 from unittest import TestCase
 
+from django.test import TestCase as DjangoTestCase
+
 from lizard_datasource import datasource
 from lizard_datasource import dummy_datasource
 from lizard_datasource import criteria
+from lizard_datasource import models
+from lizard_datasource import timeseries
 
 
 class TestChoicesMade(TestCase):
@@ -114,6 +119,128 @@ class TestChoicesMade(TestCase):
         self.assertTrue(("b", "value") in l)
 
 
+class TestDataSource(TestCase):
+    def test_copy_knows_what_it_was_copied_from(self):
+        ds = datasource.DataSource()
+        self.assertTrue(ds.copied_from is ds)
+        self.assertTrue(ds.copy().copy().copied_from is ds)
+
+    def test_copy_has_its_own_choices_made(self):
+        ds = dummy_datasource.DummyDataSource()
+        ds.set_choices_made(datasource.ChoicesMade(first_letter='ae'))
+        copy = ds.copy()
+        copy.set_choices_made(datasource.ChoicesMade(first_letter='gz'))
+        self.assertEquals(ds.get_choices_made()['first_letter'], 'ae')
+
+    def test_timeseries_many_calls_timeseries_for_each_location(self):
+        ds = datasource.DataSource()
+        with mock.patch.object(
+            ds, 'timeseries', side_effect=lambda l, s, e: l.upper()) as mocked:
+            result = ds.timeseries_many(['a', 'b'], 1, 2)
+            self.assertEquals(result, {'a': 'A', 'b': 'B'})
+            mocked.assert_called_with('b', 1, 2)
+
+    def test_timeseries_downsampled_downsamples_timeseries(self):
+        ds = datasource.DataSource()
+        ts = mock.MagicMock()
+        with mock.patch.object(ds, 'timeseries', return_value=ts):
+            result = ds.timeseries_downsampled('a', max_points=10)
+        ts.downsample.assert_called_with(10, 'lttb')
+        self.assertTrue(result is ts.downsample.return_value)
+
+    def test_lazy_timeseries_calls_timeseries_when_needed(self):
+        ds = dummy_datasource.DummyDataSource()
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'timeseries',
+            return_value=timeseries.Timeseries({})) as mocked:
+            ts = ds.lazy_timeseries('almere', 1, 2)
+            self.assertFalse(mocked.called)
+            len(ts)
+        mocked.assert_called_with('almere', 1, 2)
+
+    def test_timeseries_downsampled_without_max_points(self):
+        ds = datasource.DataSource()
+        ts = mock.MagicMock()
+        with mock.patch.object(ds, 'timeseries', return_value=ts):
+            self.assertTrue(ds.timeseries_downsampled('a') is ts)
+        self.assertFalse(ts.downsample.called)
+
+
+class TestMemoizedOptionsForCriterion(DjangoTestCase):
+    def setUp(self):
+        self.ds = dummy_datasource.DummyDataSource()
+        self.ds.set_choices_made(datasource.ChoicesMade())
+        self.criterion = self.ds.criteria()[1]
+
+    def test_options_are_computed_once(self):
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'options_for_criterion',
+            return_value=criteria.EmptyOptions()) as mocked:
+            self.ds.memoized_options_for_criterion(self.criterion)
+            self.ds.memoized_options_for_criterion(self.criterion)
+        self.assertEquals(mocked.call_count, 1)
+
+    def test_new_choices_forget_options(self):
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'options_for_criterion',
+            return_value=criteria.EmptyOptions()) as mocked:
+            self.ds.memoized_options_for_criterion(self.criterion)
+            self.ds.set_choices_made(datasource.ChoicesMade(appname='x'))
+            self.ds.memoized_options_for_criterion(self.criterion)
+        self.assertEquals(mocked.call_count, 2)
+
+    def test_copy_with_other_choices_gets_other_options(self):
+        self.ds.memoized_options_for_criterion(self.criterion)
+        copy = self.ds.copy()
+        copy.set_choices_made(datasource.ChoicesMade(appname='x'))
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'options_for_criterion',
+            return_value=criteria.EmptyOptions()):
+            self.assertEquals(
+                len(copy.memoized_options_for_criterion(self.criterion)), 0)
+        self.assertEquals(
+            len(self.ds.memoized_options_for_criterion(self.criterion)), 2)
+
+    def test_copy_doesnt_get_remembered_options(self):
+        self.ds.memoized_options_for_criterion(self.criterion)
+        copy = self.ds.copy()
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'options_for_criterion',
+            return_value=criteria.EmptyOptions()) as mocked:
+            copy.memoized_options_for_criterion(self.criterion)
+        self.assertTrue(mocked.called)
+
+    def test_handed_out_datasources_dont_share_options(self):
+        self.ds.datasource_model.visible = True
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[self.ds]):
+            datasource.invalidate_datasource_registry()
+            first = datasource.datasource()
+            first.memoized_options_for_criterion(self.criterion)
+            second = datasource.datasource()
+        datasource.invalidate_datasource_registry()
+        self.assertEquals(second._options_memo, None)
+
+    def test_chooseable_criteria_asks_once_per_criterion(self):
+        options = self.ds.options_for_criterion
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'options_for_criterion',
+            side_effect=options) as mocked:
+            self.ds.chooseable_criteria()
+            self.ds.visible_criteria()
+        self.assertEquals(mocked.call_count, len(self.ds.criteria()))
+
+    def test_combined_datasource_uses_memoized_options(self):
+        cds = datasource.CombinedDataSource([self.ds])
+        cds.set_choices_made(datasource.ChoicesMade())
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'options_for_criterion',
+            return_value=criteria.EmptyOptions()) as mocked:
+            cds.chooseable_criteria()
+        self.assertEquals(mocked.call_count, len(self.ds.criteria()))
+
+
 class TestCombinedDatasource(TestCase):
     def test_has_identifier(self):
         ds = datasource.CombinedDataSource([
@@ -248,17 +375,26 @@ class TestCombinedDatasource(TestCase):
 
 
 class TestDatasourceEntrypointsFunction(TestCase):
+    def setUp(self):
+        # It's memoized, and other tests may have called it already
+        datasource.datasource_entrypoints.cache_clear()
+
+    def tearDown(self):
+        datasource.datasource_entrypoints.cache_clear()
+
     def test_returns_tuple(self):
-        # There isn't much we can test -- just call it and see if we
-        # get something in return
         with mock.patch(
             'pkg_resources.iter_entry_points', return_value=iter([2, 3, 4])):
-            self.assertTrue(
-                datasource.datasource_entrypoints())
+            self.assertEquals(
+                datasource.datasource_entrypoints(), (2, 3, 4))
 
-            # Note that we can't check if the return value is equal to
-            # (2, 3, 4), because the function may have been called
-            # earlier, and it's memoized.
+    def test_is_memoized(self):
+        with mock.patch(
+            'pkg_resources.iter_entry_points',
+            return_value=iter([2, 3, 4])) as mocked:
+            datasource.datasource_entrypoints()
+            datasource.datasource_entrypoints()
+            self.assertEquals(mocked.call_count, 1)
 
 
 class TestDatasourcesFromEntrypointsFunction(TestCase):
@@ -294,7 +430,159 @@ class TestDatasourcesFromEntrypointsFunction(TestCase):
                 ["whee"])
 
 
-class TestGetDatasources(TestCase):
+class TestRegisteredDatasources(TestCase):
+    def setUp(self):
+        datasource.invalidate_datasource_registry()
+
+    def tearDown(self):
+        datasource.invalidate_datasource_registry()
+
+    def test_datasources_are_only_created_once(self):
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=["whee"]) as mocked:
+            datasource.registered_datasources()
+            self.assertEquals(
+                datasource.registered_datasources(), ["whee"])
+            self.assertEquals(mocked.call_count, 1)
+
+    def test_invalidating_creates_them_again(self):
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=["whee"]) as mocked:
+            datasource.registered_datasources()
+            datasource.invalidate_datasource_registry()
+            datasource.registered_datasources()
+            self.assertEquals(mocked.call_count, 2)
+
+    def test_other_threads_get_their_own_datasources(self):
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            side_effect=lambda: [object()]):
+            mine = datasource.registered_datasources()
+            theirs = []
+            thread = threading.Thread(
+                target=lambda: theirs.extend(
+                    datasource.registered_datasources()))
+            thread.start()
+            thread.join()
+            self.assertFalse(mine[0] is theirs[0])
+
+
+class TestGetDatasourceByModel(TestCase):
+    def setUp(self):
+        datasource.invalidate_datasource_registry()
+        self.ds1 = dummy_datasource.DummyDataSource()
+        self.ds2 = dummy_datasource.DummyDataSource()
+        self.datasource_model = mock.MagicMock(
+            originating_app=self.ds1.originating_app,
+            identifier=self.ds1.identifier)
+
+    def tearDown(self):
+        datasource.invalidate_datasource_registry()
+
+    def test_finds_datasource(self):
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[datasource.DataSource(), self.ds1]):
+            result = datasource.get_datasource_by_model(
+                self.datasource_model)
+            self.assertTrue(isinstance(
+                    result, dummy_datasource.DummyDataSource))
+
+    def test_returns_a_copy(self):
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[self.ds1]):
+            self.assertFalse(datasource.get_datasource_by_model(
+                    self.datasource_model) is self.ds1)
+
+    def test_returns_none_if_not_found(self):
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[datasource.DataSource()]):
+            self.assertEquals(datasource.get_datasource_by_model(
+                    self.datasource_model), None)
+
+    def test_exclude_skips_that_datasource(self):
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[self.ds1, self.ds2]):
+            result = datasource.get_datasource_by_model(
+                self.datasource_model, exclude=self.ds1)
+        self.assertTrue(result.copied_from is self.ds2)
+
+    def test_exclude_can_be_a_copy(self):
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[self.ds1]):
+            self.assertEquals(datasource.get_datasource_by_model(
+                    self.datasource_model, exclude=self.ds1.copy()), None)
+
+
+class TestGetDatasourceModel(DjangoTestCase):
+    def setUp(self):
+        datasource.invalidate_datasource_registry()
+
+    def tearDown(self):
+        datasource.invalidate_datasource_registry()
+
+    def test_missing_models_are_created_at_once(self):
+        ds1 = dummy_datasource.DummyDataSource()
+        ds2 = datasource.DataSource()
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[ds1, ds2]):
+            with mock.patch(
+                'lizard_datasource.models.DatasourceModel.save') as save:
+                dsm = ds1.datasource_model
+                self.assertFalse(save.called)
+
+            self.assertEquals(dsm.identifier, ds1.identifier)
+            self.assertEquals(models.DatasourceModel.objects.count(), 2)
+            self.assertTrue(ds2.datasource_model.pk)
+
+    def test_unregistered_datasource_gets_a_model_too(self):
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[]):
+            ds = dummy_datasource.DummyDataSource()
+            self.assertTrue(ds.datasource_model.pk)
+
+
+class TestDatasourceLayer(DjangoTestCase):
+    def setUp(self):
+        datasource._datasource_layers.clear()
+        self.ds = dummy_datasource.DummyDataSource()
+        self.ds.set_choices_made(datasource.ChoicesMade(first_letter='ae'))
+
+    def test_layer_is_only_looked_up_once(self):
+        layer = self.ds.datasource_layer
+        with mock.patch(
+            'lizard_datasource.models.DatasourceLayer.objects') as mocked:
+            self.assertEquals(self.ds.datasource_layer.pk, layer.pk)
+            self.assertFalse(mocked.get_or_create.called)
+
+    def test_changes_to_layer_arent_seen_by_others(self):
+        layer = self.ds.datasource_layer
+        layer.nickname = "changed"
+        self.assertNotEquals(self.ds.datasource_layer.nickname, "changed")
+
+    def test_saving_layer_forgets_it(self):
+        layer = self.ds.datasource_layer
+        layer.nickname = "test"
+        layer.save()
+        self.assertFalse(self.ds.datasource_layer is layer)
+        self.assertEquals(self.ds.datasource_layer.nickname, "test")
+
+
+class TestGetDatasources(DjangoTestCase):
+    def setUp(self):
+        datasource.invalidate_datasource_registry()
+
+    def tearDown(self):
+        datasource.invalidate_datasource_registry()
+
     def test_returns_applicable_datasource(self):
         ds = mock.MagicMock()
         ds.visible = True
@@ -305,7 +593,31 @@ class TestGetDatasources(TestCase):
             return_value=[ds]):
             self.assertEquals(
                 datasource.get_datasources(),
-                [ds])
+                [ds.copy.return_value])
+
+    def test_calls_keep_their_own_choices(self):
+        ds = dummy_datasource.DummyDataSource()
+        ds.datasource_model.visible = True
+
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[ds]):
+            first = datasource.datasource(
+                datasource.ChoicesMade(first_letter='ae'))
+            second = datasource.datasource(
+                datasource.ChoicesMade(first_letter='gz'))
+
+        self.assertEquals(first.get_choices_made()['first_letter'], 'ae')
+        self.assertEquals(second.get_choices_made()['first_letter'], 'gz')
+
+    def test_combined_datasource_copies_its_datasources(self):
+        ds = dummy_datasource.DummyDataSource()
+        combined = datasource.CombinedDataSource([ds])
+        combined.set_choices_made(datasource.ChoicesMade(first_letter='ae'))
+
+        copy = combined.copy()
+        copy.set_choices_made(datasource.ChoicesMade(first_letter='gz'))
+        self.assertEquals(ds.get_choices_made()['first_letter'], 'ae')
 
 
 class TestDataSourceFunction(TestCase):
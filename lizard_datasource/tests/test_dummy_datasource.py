@@ -21,3 +21,8 @@ class TestDummyDatasource(TestCase):
         self.assertTrue(options.is_option_list)
         self.assertEquals(len(options), 1)
 
+    def test_timeseries_many_returns_timeseries_per_location(self):
+        result = self.ds.timeseries_many(['almere', 'breda'])
+        self.assertEquals(sorted(result), ['almere', 'breda'])
+        self.assertEquals(
+            result['breda'].values(), self.ds.timeseries('breda').values())
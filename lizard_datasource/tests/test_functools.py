@@ -1,5 +1,7 @@
 """Tests for lizard_datasource.functools"""
 
+import mock
+
 from django.test import TestCase
 
 from lizard_datasource import functools
@@ -24,3 +26,137 @@ class TestMemoized(TestCase):
         o1 = helper(1)
         o2 = helper(2)
         self.assertFalse(o1 is o2)
+
+    def test_keyword_argument_order_doesnt_matter(self):
+        @functools.memoize
+        def helper(a=None, b=None):
+            return object()
+
+        self.assertTrue(helper(a=1, b=2) is helper(b=2, a=1))
+
+    def test_maxsize(self):
+        @functools.memoize(maxsize=2)
+        def helper(arg):
+            return object()
+
+        o1 = helper(1)
+        helper(2)
+        helper(3)
+        self.assertFalse(helper(1) is o1)
+        self.assertEquals(helper.cache_info().currsize, 2)
+
+    def test_maxsize_none_is_unbounded(self):
+        @functools.memoize(maxsize=None)
+        def helper(arg):
+            return object()
+
+        o1 = helper(1)
+        for i in range(200):
+            helper(i + 2)
+        self.assertTrue(helper(1) is o1)
+        self.assertEquals(helper.cache_info().currsize, 201)
+
+    def test_ttl(self):
+        @functools.memoize(ttl=10)
+        def helper(arg):
+            return object()
+
+        with mock.patch('time.time', return_value=100):
+            o1 = helper(1)
+        with mock.patch('time.time', return_value=111):
+            self.assertFalse(helper(1) is o1)
+
+    def test_none_is_remembered(self):
+        f = mock.MagicMock(return_value=None)
+        f.__name__ = str('f')
+        helper = functools.memoize(f)
+        helper(1)
+        helper(1)
+        self.assertEquals(f.call_count, 1)
+
+    def test_cache_info_and_cache_clear(self):
+        @functools.memoize
+        def helper(arg):
+            return object()
+
+        o1 = helper(1)
+        helper(1)
+        helper(2)
+        self.assertEquals(
+            helper.cache_info(), functools.CacheInfo(1, 2, 128, 2))
+
+        helper.cache_clear()
+        self.assertEquals(
+            helper.cache_info(), functools.CacheInfo(0, 0, 128, 0))
+        self.assertFalse(helper(1) is o1)
+
+
+class TestLRUCache(TestCase):
+    def test_get_returns_value_that_was_set(self):
+        cache = functools.LRUCache()
+        cache.set('a', 1)
+        self.assertEquals(cache.get('a'), 1)
+
+    def test_get_returns_default_for_missing_key(self):
+        cache = functools.LRUCache()
+        self.assertEquals(cache.get('a', 2), 2)
+
+    def test_least_recently_used_item_is_forgotten(self):
+        cache = functools.LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEquals(len(cache), 2)
+
+    def test_len_doesnt_count_expired_items(self):
+        cache = functools.LRUCache(ttl=10)
+        with mock.patch('time.time', return_value=100):
+            cache.set('a', 1)
+            cache.set('b', 2, ttl=100)
+        with mock.patch('time.time', return_value=150):
+            self.assertEquals(len(cache), 1)
+            self.assertFalse('a' in cache)
+
+    def test_cache_info_doesnt_count_expired_results(self):
+        @functools.memoize(ttl=10)
+        def helper(arg):
+            return arg
+
+        with mock.patch('time.time', return_value=100):
+            helper(1)
+        with mock.patch('time.time', return_value=111):
+            self.assertEquals(helper.cache_info().currsize, 0)
+
+    def test_maxsize_none_keeps_everything(self):
+        cache = functools.LRUCache(maxsize=None)
+        for i in range(1000):
+            cache.set(i, i)
+        self.assertEquals(len(cache), 1000)
+        self.assertEquals(cache.get(0), 0)
+
+    def test_items_older_than_ttl_are_forgotten(self):
+        cache = functools.LRUCache(ttl=10)
+        with mock.patch('time.time', return_value=100):
+            cache.set('a', 1)
+        with mock.patch('time.time', return_value=105):
+            self.assertEquals(cache.get('a'), 1)
+        with mock.patch('time.time', return_value=111):
+            self.assertEquals(cache.get('a'), None)
+
+    def test_pop_removes_item(self):
+        cache = functools.LRUCache()
+        cache.set('a', 1)
+        self.assertEquals(cache.pop('a'), 1)
+        self.assertFalse('a' in cache)
+
+    def test_set_can_give_item_its_own_ttl(self):
+        cache = functools.LRUCache(ttl=10)
+        with mock.patch('time.time', return_value=100):
+            cache.set('a', 1, ttl=20)
+            cache.set('b', 2)
+        with mock.patch('time.time', return_value=115):
+            self.assertEquals(cache.get('a'), 1)
+            self.assertEquals(cache.get('b'), None)
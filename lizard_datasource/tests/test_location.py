@@ -1,5 +1,7 @@
 """Tests for lizard_datasource.location"""
 
+import json
+
 from lizard_datasource import location
 
 from django.test import TestCase
@@ -47,3 +49,74 @@ class TestLocation(TestCase):
         l = location.Location(
             'identifier', 0.0, 1.0)
         self.assertEquals(unicode(l), repr(l))
+
+    def test_has_no_instance_dict(self):
+        l = location.Location('identifier', 0.0, 1.0)
+        self.assertFalse(hasattr(l, '__dict__'))
+
+
+class TestLocationSet(TestCase):
+    def setUp(self):
+        self.locations = [
+            location.Location('a', 52.0, 5.0, name="A"),
+            location.Location('b', 53.5, 6.25, color="ff0000")]
+        self.location_set = location.LocationSet.from_locations(
+            self.locations)
+
+    def test_length_and_iteration(self):
+        self.assertEquals(len(self.location_set), 2)
+        self.assertEquals(
+            [l.identifier for l in self.location_set], ['a', 'b'])
+
+    def test_rows_are_locations(self):
+        l = self.location_set[-1]
+        self.assertTrue(isinstance(l, location.Location))
+        self.assertEquals(l.identifier, 'b')
+        self.assertEquals(l.latitude, 53.5)
+        self.assertEquals(l.longitude, 6.25)
+        self.assertEquals(l.color, 'ff0000')
+        self.assertEquals(self.location_set[0].description(), "A")
+
+    def test_index_error(self):
+        self.assertRaises(IndexError, lambda: self.location_set[2])
+
+    def test_setting_color_of_a_row_changes_the_set(self):
+        self.location_set[0].color = "00ff00"
+        self.assertEquals(self.location_set.colors[0], "00ff00")
+
+    def test_with_colors_doesnt_change_the_original(self):
+        colored = self.location_set.with_colors(["000000", "ffffff"])
+        self.assertEquals(colored[1].color, "ffffff")
+        self.assertEquals(self.location_set[1].color, "ff0000")
+
+    def test_to_dicts_is_like_to_dict(self):
+        self.assertEquals(
+            self.location_set.to_dicts(),
+            [l.to_dict() for l in self.locations])
+
+    def test_views_only_have_keys_their_location_had(self):
+        self.assertEquals(
+            [l.to_dict() for l in self.location_set],
+            [l.to_dict() for l in self.locations])
+        self.assertEquals(
+            [l.description() for l in self.location_set],
+            [l.description() for l in self.locations])
+
+    def test_to_json(self):
+        self.assertEquals(
+            json.loads(self.location_set.to_json()),
+            self.location_set.to_dicts())
+
+    def test_to_geojson(self):
+        geojson = json.loads(self.location_set.to_geojson())
+        self.assertEquals(geojson['type'], 'FeatureCollection')
+        feature = geojson['features'][1]
+        self.assertEquals(feature['geometry']['coordinates'], [6.25, 53.5])
+        self.assertEquals(
+            feature['properties'],
+            {'identifier': 'b', 'color': 'ff0000'})
+
+    def test_empty_set(self):
+        location_set = location.LocationSet([], [], [])
+        self.assertEquals(json.loads(location_set.to_json()), [])
+        self.assertEquals(list(location_set), [])
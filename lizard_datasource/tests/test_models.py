@@ -1,8 +1,10 @@
 import datetime
 import factory
 import mock
+import numpy
 
 from django.test import TestCase
+from lizard_datasource import datasource
 from lizard_datasource import dates
 from lizard_datasource import models
 
@@ -64,6 +66,13 @@ class ColorMapLineF(factory.DjangoModelFactory):
     color = "00ff00"
 
 
+class IdentifierMappingF(factory.DjangoModelFactory):
+    class Meta:
+        model = models.IdentifierMapping
+
+    name = "some_mapping"
+
+
 # Test classes
 
 
@@ -71,6 +80,11 @@ class TestDatasourceModel(TestCase):
     def test_has_unicode(self):
         self.assertTrue(unicode(DatasourceModelF.build()))
 
+    def test_saving_invalidates_datasource_registry(self):
+        version = datasource._registry_version
+        DatasourceModelF.create()
+        self.assertNotEquals(datasource._registry_version, version)
+
     def test_cache_script_is_due_if_not_run_yet(self):
         # Say it's 0:30 AM now and it hasn't run yet, it should
         dt = dates.utc_now().replace(hour=0, minute=30)
@@ -197,3 +211,108 @@ class TestColorMap(TestCase):
 
         color = cm.color_for(25)
         self.assertEquals(color, "00ff00")
+
+
+class TestCompiledColorMap(TestCase):
+    def setUp(self):
+        self.cm = ColorMapF.create(defaultcolor="00ff00")
+        ColorMapLineF.create(
+            minvalue=None, maxvalue=0, color="000000", colormap=self.cm)
+        ColorMapLineF.create(
+            minvalue=0, maxvalue=10, color="ff0000", colormap=self.cm)
+        ColorMapLineF.create(
+            minvalue=10, maxvalue=20, mininclusive=True, maxinclusive=False,
+            color="0000ff", colormap=self.cm)
+        ColorMapLineF.create(
+            minvalue=30, maxvalue=None, mininclusive=True,
+            color="ffffff", colormap=self.cm)
+
+    def test_same_colors_as_color_for(self):
+        values = [-5, 0, 0.5, 10, 15, 20, 25, 30, 1e10]
+        colors = self.cm.compiled().colors_for(values)
+        self.assertEquals(
+            list(colors), [self.cm.color_for(value) for value in values])
+
+    def test_default_color_without_lines(self):
+        cm = ColorMapF.create(defaultcolor="00ff00")
+        colors = cm.compiled().colors_for([1.0, 2.0])
+        self.assertEquals(list(colors), ["00ff00", "00ff00"])
+
+
+class TestIdentifierMapping(TestCase):
+    def setUp(self):
+        self.mapping = IdentifierMappingF.create()
+
+    def lines(self):
+        return dict(models.IdentifierMappingLine.objects.filter(
+                mapping=self.mapping).values_list(
+                'identifier_from', 'identifier_to'))
+
+    def test_map_many_to_adds_and_changes_lines(self):
+        self.mapping.map_to("a", "x")
+        self.mapping.map_to("b", "y")
+
+        self.mapping.map_many_to({"a": "z", "c": "x"}, chunk_size=1)
+
+        self.assertEquals(self.lines(), {"a": "z", "b": "y", "c": "x"})
+
+    def test_map_many_to_invalidates_mapping_once(self):
+        self.mapping.map_to("a", "x")
+        self.mapping.map_to("b", "y")
+
+        with mock.patch(
+            'lizard_datasource.models.invalidate_identifier_mapping'
+            ) as mocked:
+            self.mapping.map_many_to({"a": "z", "b": "z"})
+        mocked.assert_called_once_with(self.mapping.id)
+
+    def test_create_proximity_map(self):
+        self.mapping.create_proximity_map(
+            {"a": (0, 0), "b": (10, 10), "c": (100, 100)},
+            {"x": (1, 1), "y": (9, 9)},
+            max_distance=5)
+
+        self.assertEquals(self.lines(), {"a": "x", "b": "y"})
+
+    def test_create_proximity_map_prefers_lowest_identifier(self):
+        self.mapping.create_proximity_map(
+            {"a": (0, 0)},
+            {"y": (1, 0), "x": (-1, 0)},
+            max_distance=None)
+
+        self.assertEquals(self.lines(), {"a": "x"})
+
+    def test_map_many(self):
+        self.mapping.map_to("a", "x")
+        self.assertEquals(
+            self.mapping.map_many(["a", "b"]), {"a": "x", "b": None})
+
+    def test_lines_are_loaded_once(self):
+        self.mapping.map_to("a", "x")
+        self.mapping.map_to("b", "y")
+
+        with self.assertNumQueries(1):
+            self.assertEquals(self.mapping.map("a"), "x")
+            self.assertEquals(self.mapping.map("b"), "y")
+            self.assertEquals(self.mapping.map("c"), None)
+
+    def test_saving_a_line_invalidates_lines(self):
+        self.mapping.map_to("a", "x")
+        self.assertEquals(self.mapping.map("a"), "x")
+
+        self.mapping.map_to("a", "y")
+        self.assertEquals(self.mapping.map("a"), "y")
+
+        self.mapping.map_many_to({"a": "z"})
+        self.assertEquals(self.mapping.map("a"), "z")
+
+        models.IdentifierMappingLine.objects.all().delete()
+        self.assertEquals(self.mapping.map("a"), None)
+
+    def test_create_proximity_map_from_points(self):
+        self.mapping.create_proximity_map_from_points(
+            ["a", "b"], numpy.array([[0.0, 0.0], [10.0, 10.0]]),
+            ["y", "x"], numpy.array([[9.0, 9.0], [1.0, 1.0]]),
+            max_distance=None)
+
+        self.assertEquals(self.lines(), {"a": "x", "b": "y"})
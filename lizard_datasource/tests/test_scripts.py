@@ -1,11 +1,17 @@
 """Tests for lizard_datasource.scripts."""
 
 import mock
+import pandas
 
 from django.test import TestCase
 
 from lizard_datasource import datasource
+from lizard_datasource import dates
+from lizard_datasource import dummy_datasource
+from lizard_datasource import models
+from lizard_datasource import properties
 from lizard_datasource import scripts
+from lizard_datasource.tests import test_models
 
 
 class TestYieldLayers(TestCase):
@@ -15,3 +21,123 @@ class TestYieldLayers(TestCase):
         layers = list(scripts._yield_drawable_datasources(ds))
         self.assertEquals(len(layers), 1)
         self.assertTrue(layers[0] is ds)
+
+
+class TestSaveCacheRows(TestCase):
+    def test_inserts_new_and_updates_existing_rows(self):
+        layer = test_models.DatasourceLayerF.create(choices_made="{}")
+        existing = models.DatasourceCache.objects.create(
+            datasource_layer=layer, locationid="a",
+            timestamp=dates.utc(2012, 11, 13, 11, 0), value=1.0)
+        existing.value = 2.0
+        new = models.DatasourceCache(
+            datasource_layer=layer, locationid="b",
+            timestamp=dates.utc(2012, 11, 13, 11, 0), value=3.0)
+
+        scripts._save_cache_rows([existing, new], chunk_size=1)
+
+        self.assertEquals(models.DatasourceCache.objects.count(), 2)
+        self.assertEquals(
+            models.DatasourceCache.objects.get(pk=existing.pk).value, 2.0)
+        self.assertEquals(
+            models.DatasourceCache.objects.get(pk=existing.pk).timestamp,
+            dates.utc(2012, 11, 13, 11, 0))
+        self.assertEquals(
+            models.DatasourceCache.objects.get(locationid="b").value, 3.0)
+
+
+class TestCacheLayer(TestCase):
+    def setUp(self):
+        self.ds = dummy_datasource.DummyDataSource()
+        self.ds.set_choices_made(
+            datasource.ChoicesMade(appname="lizard_datasource",
+                                   first_letter="ae"))
+        self.layer = self.ds.datasource_layer
+
+    def test_caches_latest_value_of_each_location(self):
+        scripts._cache_layer(self.ds, self.layer)
+
+        ds_caches = models.DatasourceCache.objects.filter(
+            datasource_layer=self.layer)
+        self.assertEquals(
+            ds_caches.count(), len(dummy_datasource.CITIES['ae']))
+        self.assertTrue(all(ds_cache.value == 14.0 for ds_cache in ds_caches))
+
+    def test_unchanged_values_arent_written_again(self):
+        scripts._cache_layer(self.ds, self.layer)
+        with mock.patch('lizard_datasource.models.save_in_chunks') as mocked:
+            scripts._cache_layer(self.ds, self.layer)
+        self.assertEquals(mocked.call_args[0][1], [])
+
+    def test_only_sleeps_if_datasource_asks_for_it(self):
+        with mock.patch('time.sleep') as sleep:
+            scripts._cache_layer(self.ds, self.layer)
+            self.assertFalse(sleep.called)
+
+            self.ds.cache_script_delay = lambda: 0.5
+            scripts._cache_layer(self.ds, self.layer)
+            sleep.assert_called_with(0.5)
+
+    def test_uses_latest_values_if_datasource_has_them(self):
+        timestamp = dates.utc(2012, 11, 13, 15, 0)
+        latest_values = pandas.DataFrame(
+            {'timestamp': [timestamp, timestamp],
+             'value': [1.0, 2.0]},
+            index=['almere', 'breda'])
+
+        self.ds.PROPERTIES = self.ds.PROPERTIES + (
+            properties.DATA_CAN_HAVE_VALUE_LAYER,)
+        self.ds.latest_values = lambda: latest_values
+        with mock.patch.object(self.ds, 'timeseries_many') as mocked:
+            scripts._cache_layer(self.ds, self.layer)
+            self.assertFalse(mocked.called)
+
+        self.assertEquals(models.DatasourceCache.objects.get(
+                datasource_layer=self.layer, locationid='breda').value, 2.0)
+
+    def test_value_layer_without_latest_values_isnt_crawled(self):
+        self.ds.PROPERTIES = (
+            properties.LAYER_POINTS, properties.DATA_CAN_HAVE_VALUE_LAYER)
+        self.ds.latest_values = lambda: None
+        with mock.patch.object(self.ds, 'timeseries_many') as mocked:
+            scripts._cache_layer(self.ds, self.layer)
+            self.assertFalse(mocked.called)
+
+        self.assertFalse(models.DatasourceCache.objects.filter(
+                datasource_layer=self.layer).exists())
+
+    def test_falls_back_to_timeseries_with_value_layer_script(self):
+        self.ds.PROPERTIES = self.ds.PROPERTIES + (
+            properties.DATA_CAN_HAVE_VALUE_LAYER,)
+        self.ds.latest_values = lambda: None
+        scripts._cache_layer(self.ds, self.layer)
+
+        self.assertEquals(
+            models.DatasourceCache.objects.filter(
+                datasource_layer=self.layer).count(),
+            len(dummy_datasource.CITIES['ae']))
+
+
+class TestCacheLatestValues(TestCase):
+    def test_workers_get_their_own_datasource(self):
+        ds = dummy_datasource.DummyDataSource()
+        drawables = []
+
+        def cache_drawable(drawable, allow_cache, chunk_size):
+            drawables.append((drawable, drawable.get_choices_made()))
+
+        with mock.patch(
+            'lizard_datasource.datasource.get_datasource_by_model',
+            side_effect=lambda dsm: dummy_datasource.DummyDataSource()):
+            with mock.patch(
+                'lizard_datasource.scripts._cache_drawable',
+                side_effect=cache_drawable):
+                scripts.cache_latest_values(
+                    ds, allow_cache=False, workers=2)
+
+        self.assertEquals(
+            sorted(choices_made['first_letter']
+                   for drawable, choices_made in drawables),
+            ['ae', 'gz'])
+        self.assertTrue(all(drawable is not ds
+                            for drawable, choices_made in drawables))
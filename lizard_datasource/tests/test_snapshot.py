@@ -0,0 +1,228 @@
+"""Tests for lizard_datasource.snapshot"""
+
+import mock
+
+from django.core.cache import get_cache
+from django.test import TestCase
+
+from lizard_datasource import augmented_datasource
+from lizard_datasource import criteria
+from lizard_datasource import datasource
+from lizard_datasource import dummy_datasource
+from lizard_datasource import snapshot
+from lizard_datasource.tests import test_models
+
+
+class TestSerialization(TestCase):
+    def test_criterion_roundtrip(self):
+        criterion = criteria.Criterion(
+            'parameter', 'Parameter', datatype=criteria.Criterion.TYPE_TREE,
+            prerequisites=('appname',))
+        result = snapshot._criterion_from_dict(
+            snapshot._criterion_to_dict(criterion))
+
+        self.assertEquals(result, criterion)
+        self.assertEquals(result.description, 'Parameter')
+        self.assertTrue(result.datatype is criteria.Criterion.TYPE_TREE)
+        self.assertEquals(result.prerequisites, ('appname',))
+
+    def test_option_list_roundtrip(self):
+        options = criteria.OptionList((
+                criteria.Option('a', 'A'), criteria.Option('b', 'B')))
+        result = snapshot._options_from_dict(
+            snapshot._options_to_dict(options))
+
+        self.assertTrue(result.is_option_list)
+        self.assertEquals(
+            [(o.identifier, o.description) for o in result.iter_options()],
+            [('a', 'A'), ('b', 'B')])
+
+    def test_option_tree_roundtrip(self):
+        tree = criteria.OptionTree(description='Root', children=[
+                criteria.OptionTree(option=criteria.Option('a', 'A')),
+                criteria.OptionTree(description='Sub', children=[
+                        criteria.OptionTree(
+                            option=criteria.Option('b', 'B'))])])
+        result = snapshot._options_from_dict(
+            snapshot._options_to_dict(tree))
+
+        self.assertTrue(result.is_option_tree)
+        self.assertEquals(result.description, 'Root')
+        self.assertEquals(result.children[1].description, 'Sub')
+        self.assertEquals(
+            [o.identifier for o in result.iter_options()], ['a', 'b'])
+
+    def test_empty_options_roundtrip(self):
+        result = snapshot._options_from_dict(
+            snapshot._options_to_dict(criteria.EmptyOptions()))
+        self.assertEquals(len(result), 0)
+
+    def test_unknown_options_raise_type_error(self):
+        self.assertRaises(
+            TypeError, snapshot._options_to_dict, criteria.Options())
+
+
+class TwoCriteriaDataSource(datasource.DataSource):
+    """Two independent criteria with two options each, never
+    drawable."""
+
+    @property
+    def identifier(self):
+        return "two_criteria"
+
+    def criteria(self):
+        return (criteria.Criterion('a', 'A'), criteria.Criterion('b', 'B'))
+
+    def options_for_criterion(self, criterion):
+        return criteria.OptionList(
+            criteria.Option(identifier, identifier) for identifier in '12')
+
+    def is_drawable(self, choices_made=None):
+        return False
+
+
+class TestSnapshot(TestCase):
+    def setUp(self):
+        self.ds = dummy_datasource.DummyDataSource()
+        self.ds.set_choices_made(datasource.ChoicesMade())
+
+    def tearDown(self):
+        snapshot.forget(self.ds)
+
+    def test_build_visits_all_choices(self):
+        result = snapshot.Snapshot.build(self.ds)
+
+        self.assertEquals(
+            sorted(result.nodes), [
+                '{"first_letter": "ae"}', '{"first_letter": "gz"}', '{}'])
+
+    def test_build_leaves_ds_alone(self):
+        snapshot.Snapshot.build(self.ds)
+        self.assertEquals(self.ds.get_choices_made().json(), '{}')
+
+    def test_choices_reached_in_any_order_are_visited_once(self):
+        ds = TwoCriteriaDataSource()
+        ds.set_choices_made(datasource.ChoicesMade())
+        with mock.patch.object(
+            TwoCriteriaDataSource, 'chooseable_criteria', autospec=True,
+            side_effect=lambda self: self._chooseable_criteria()) as mocked:
+            result = snapshot.Snapshot.build(ds)
+
+        # {}, two with one choice each, and four with both
+        self.assertEquals(len(result), 9)
+        self.assertEquals(mocked.call_count, 9)
+
+    def test_max_nodes(self):
+        result = snapshot.Snapshot.build(self.ds, max_nodes=1)
+        self.assertEquals(len(result), 1)
+
+    def test_answers_like_the_datasource(self):
+        expected = self.ds.chooseable_criteria()
+        result = snapshot.Snapshot.build(self.ds).chooseable_criteria(
+            datasource.ChoicesMade())
+
+        self.assertEquals(
+            [c['criterion'] for c in result],
+            [c['criterion'] for c in expected])
+        self.assertEquals(
+            [sorted(o.identifier for o in c['options'].iter_options())
+             for c in result],
+            [sorted(o.identifier for o in c['options'].iter_options())
+             for c in expected])
+
+    def test_unknown_choices_give_none(self):
+        result = snapshot.Snapshot.build(self.ds)
+        self.assertEquals(
+            result.chooseable_criteria(
+                datasource.ChoicesMade(first_letter='xy')),
+            None)
+
+    def test_json_roundtrip(self):
+        result = snapshot.Snapshot.build(self.ds)
+        loaded = snapshot.Snapshot.from_json(result.to_json())
+
+        self.assertEquals(loaded.nodes, result.nodes)
+        self.assertEquals(loaded.created, result.created)
+
+    def test_other_version_is_ignored(self):
+        self.assertEquals(
+            snapshot.Snapshot.from_json('{"version": -1}'), None)
+
+
+class TestRefresh(TestCase):
+    def setUp(self):
+        # Don't use DatasourceModels cached by other tests
+        datasource.invalidate_datasource_registry()
+        self.ds = dummy_datasource.DummyDataSource()
+        self.ds.set_choices_made(datasource.ChoicesMade())
+
+    def tearDown(self):
+        snapshot.forget(self.ds)
+        datasource.invalidate_datasource_registry()
+
+    def test_refresh_stores_snapshot_in_cache(self):
+        snapshot.refresh(self.ds)
+        snapshot._snapshots.clear()
+
+        self.assertTrue(get_cache('default').get(
+                snapshot.cache_key(self.ds.datasource_model.id)))
+        self.assertEquals(len(snapshot.get_snapshot(self.ds)), 3)
+
+    def test_young_snapshot_is_kept(self):
+        first = snapshot.refresh(self.ds)
+        self.assertTrue(snapshot.refresh(self.ds) is first)
+        self.assertFalse(snapshot.refresh(self.ds, max_age=0) is first)
+
+    def test_chooseable_criteria_come_from_snapshot(self):
+        snapshot.refresh(self.ds)
+
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource,
+            'options_for_criterion') as mocked:
+            result = self.ds.chooseable_criteria()
+
+        self.assertFalse(mocked.called)
+        self.assertEquals(
+            [c['criterion'].identifier for c in result], ['first_letter'])
+
+    def test_without_snapshot_datasource_is_asked(self):
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'options_for_criterion',
+            return_value=criteria.EmptyOptions()) as mocked:
+            self.ds.chooseable_criteria()
+
+        self.assertTrue(mocked.called)
+
+    def test_augmented_datasource_has_no_snapshot(self):
+        augmented = augmented_datasource.AugmentedDataSource(
+            test_models.AugmentedDataSourceF.create())
+        augmented._original_datasource = self.ds
+        with mock.patch.object(snapshot.Snapshot, 'build') as mocked:
+            self.assertEquals(snapshot.refresh(augmented), None)
+        self.assertFalse(mocked.called)
+
+    def test_combined_datasource_has_no_snapshot(self):
+        combined = datasource.CombinedDataSource([self.ds])
+        self.assertEquals(snapshot.refresh(combined), None)
+
+    def test_saving_datasource_model_forgets_snapshot(self):
+        snapshot.refresh(self.ds)
+        dsm = self.ds.datasource_model
+        dsm.visible = not dsm.visible
+        dsm.save()
+        self.assertEquals(snapshot.get_snapshot(self.ds), None)
+
+    def test_cache_script_run_doesnt_forget_snapshot(self):
+        snapshot.refresh(self.ds)
+        self.ds.datasource_model.script_run_next_opportunity = True
+        self.assertTrue(self.ds.activation_for_cache_script())
+        self.assertTrue(snapshot.get_snapshot(self.ds) is not None)
+
+    def test_color_from_latest_value_forgets_snapshot(self):
+        snapshot.refresh(self.ds)
+        test_models.ColorFromLatestValueF.create(
+            augmented_source=test_models.AugmentedDataSourceF.create(
+                augmented_source=self.ds.datasource_model),
+            layer_to_add_color_to=test_models.DatasourceLayerF.create(),
+            colormap=test_models.ColorMapF.create())
+        self.assertEquals(snapshot.get_snapshot(self.ds), None)
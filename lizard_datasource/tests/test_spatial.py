@@ -0,0 +1,71 @@
+"""Tests for lizard_datasource.spatial"""
+
+import math
+import random
+
+from unittest import TestCase
+
+from lizard_datasource import spatial
+
+
+def brute_force_nearest(points, point, max_distance=None):
+    mindistance, index = min(
+        (math.sqrt((point[0] - p[0]) ** 2 + (point[1] - p[1]) ** 2), i)
+        for i, p in enumerate(points))
+    if max_distance and mindistance > max_distance:
+        return None
+    return index
+
+
+class TestGridIndex(TestCase):
+    def test_no_points(self):
+        index = spatial.GridIndex([])
+        self.assertEquals(index.nearest((0, 0)), (None, None))
+
+    def test_single_point(self):
+        index = spatial.GridIndex([(3, 4)])
+        self.assertEquals(index.nearest((0, 0)), (0, 5.0))
+
+    def test_same_as_brute_force(self):
+        rnd = random.Random(0)
+        points = [(rnd.uniform(0, 1000), rnd.uniform(0, 1000))
+                  for i in range(200)]
+        index = spatial.GridIndex(points)
+
+        # Include queries far outside the grid
+        for i in range(200):
+            point = (rnd.uniform(-2000, 3000), rnd.uniform(-2000, 3000))
+            self.assertEquals(
+                index.nearest(point)[0],
+                brute_force_nearest(points, point))
+            self.assertEquals(
+                index.nearest(point, max_distance=50)[0],
+                brute_force_nearest(points, point, max_distance=50))
+
+    def test_ties_go_to_first_point(self):
+        points = [(5, 5), (1, 0), (-1, 0), (0, 1)]
+        index = spatial.GridIndex(points)
+        self.assertEquals(index.nearest((0, 0)), (1, 1.0))
+
+    def test_ties_on_cell_boundaries_same_as_brute_force(self):
+        # Integer coordinates give many points that are exactly as far
+        # away as the edge of the searched cells
+        rnd = random.Random(0)
+        points = [(rnd.randint(0, 20), rnd.randint(0, 20))
+                  for i in range(50)]
+        index = spatial.GridIndex(points)
+
+        for i in range(500):
+            point = (rnd.randint(-5, 25), rnd.randint(-5, 25))
+            self.assertEquals(
+                index.nearest(point)[0],
+                brute_force_nearest(points, point))
+
+    def test_duplicate_points(self):
+        index = spatial.GridIndex([(1, 1), (1, 1), (1, 1)])
+        self.assertEquals(index.nearest((1, 1)), (0, 0.0))
+
+    def test_max_distance(self):
+        index = spatial.GridIndex([(0, 0), (10, 0)])
+        self.assertEquals(index.nearest((5, 100), 50), (None, None))
+        self.assertEquals(index.nearest((1, 0), 2), (0, 1.0))
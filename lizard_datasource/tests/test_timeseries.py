@@ -1,7 +1,10 @@
 """Tests for lizard_datasource.timeseries"""
 
 import StringIO
+import unittest
 
+import mock
+import numpy
 import pandas
 import pytz
 
@@ -69,3 +72,294 @@ class TestTimeseries(TestCase):
 2014-06-24 19:32,2.0,
 2014-06-24 19:33,,4.0
 """)
+
+    def test_to_csv_doesnt_change_timezone(self):
+        ts = timeseries.Timeseries({self.some_date: self.some_value})
+        ts.to_csv(StringIO.StringIO(),
+                  timezone=pytz.timezone('Europe/Amsterdam'))
+        self.assertDataPresent(ts)
+        self.assertEquals(str(ts.dataframe.index.tz), 'UTC')
+
+    def test_iter_csv_in_chunks_is_the_same_as_to_csv(self):
+        index = pandas.date_range(
+            '2014-03-30', periods=50, freq='17min', tz='UTC')
+        ts = timeseries.Timeseries(pandas.DataFrame(
+                {'a||m': numpy.arange(50.0), 'b': numpy.arange(50.0) / 3},
+                index=index, columns=['a||m', 'b']))
+        ts.dataframe.iloc[3, 1] = numpy.nan
+        amsterdam = pytz.timezone('Europe/Amsterdam')
+
+        chunks = list(ts.iter_csv(timezone=amsterdam, chunk_size=7))
+        self.assertEquals(len(chunks), 1 + 8)
+        self.assertTrue(all(isinstance(chunk, bytes) for chunk in chunks))
+
+        outfile = StringIO.StringIO()
+        ts.to_csv(outfile, timezone=amsterdam)
+        self.assertEquals(b''.join(chunks), outfile.getvalue())
+
+        # The old way: convert everything, then write it at once
+        expected = StringIO.StringIO()
+        expected.write("Datum + tijd,a (m),b\n")
+        ts.dataframe.tz_convert(amsterdam).to_csv(
+            expected, header=None, date_format='%Y-%m-%d %H:%M')
+        self.assertEquals(b''.join(chunks), expected.getvalue())
+
+    def test_timeseries_is_cached(self):
+        ts = timeseries.Timeseries({self.some_date: self.some_value})
+        self.assertTrue(ts.timeseries is ts.timeseries)
+
+    def test_set_timezone_empties_cache(self):
+        ts = timeseries.Timeseries({self.some_date: self.some_value})
+        ts.timeseries
+        ts.set_timezone(pytz.timezone('Europe/Amsterdam'))
+        self.assertEquals(
+            str(ts.timeseries.index.tz), 'Europe/Amsterdam')
+
+    def test_values_skips_missing_values(self):
+        ts = timeseries.Timeseries([
+                {self.some_date: self.some_value},
+                {dates.utc(2013, 1, 1, 0, 0): 1.0}])
+        self.assertEquals(ts.values(), [self.some_value])
+
+    def test_data_epoch_ms(self):
+        ts = timeseries.Timeseries({
+                dates.utc(1970, 1, 1, 0, 0, 1): 1.5,
+                dates.utc(2014, 6, 24, 17, 31, 24): 2.0})
+        self.assertEquals(
+            ts.data_epoch_ms().tolist(),
+            [[1000.0, 1.5], [1403631084000.0, 2.0]])
+
+    def test_data_epoch_ms_doesnt_depend_on_timezone(self):
+        ts = timeseries.Timeseries({dates.utc(1970, 1, 1, 0, 0, 1): 1.5})
+        ts.set_timezone(pytz.timezone('Europe/Amsterdam'))
+        self.assertEquals(ts.data_epoch_ms().tolist(), [[1000.0, 1.5]])
+
+    def test_data_json(self):
+        ts = timeseries.Timeseries({
+                dates.utc(1970, 1, 1, 0, 0, 1): 1.5,
+                dates.utc(1970, 1, 1, 0, 0, 2): 2.0})
+        self.assertEquals(ts.data_json(), b'[[1000, 1.5], [2000, 2.0]]')
+
+    def test_list_constructor_keeps_column_order(self):
+        ts = timeseries.Timeseries([
+                {self.some_date: float(i)} for i in range(12)])
+        self.assertEquals(ts.columns[10], 'data_10')
+        self.assertEquals(ts.get_series('data_10')[0], 10.0)
+        self.assertEquals(ts.get_series('data_2')[0], 2.0)
+
+    def test_add_appends_columns(self):
+        dt1 = dates.utc(2014, 6, 24, 17, 31, 24)
+        dt2 = dates.utc(2014, 6, 24, 17, 32, 24)
+        ts = timeseries.Timeseries({dt1: 1.0})
+        ts.values()
+        ts.add(timeseries.Timeseries({dt1: 2.0, dt2: 3.0}))
+
+        # Same column name, but not added together
+        self.assertEquals(ts.columns, ('data', 'data'))
+        self.assertEquals(ts.values(), [1.0])
+        self.assertEquals(ts.dataframe.iloc[:, 1].tolist(), [2.0, 3.0])
+
+
+class TestMerge(TestCase):
+    def test_merges_columns_in_order_on_union_of_dates(self):
+        dt1 = dates.utc(2014, 6, 24, 17, 31, 24)
+        dt2 = dates.utc(2014, 6, 24, 17, 32, 24)
+        dt3 = dates.utc(2014, 6, 24, 17, 33, 24)
+        merged = timeseries.merge([
+                timeseries.Timeseries(pandas.DataFrame(
+                        {'water||m': pandas.Series({dt2: 1.0})})),
+                timeseries.Timeseries(pandas.DataFrame(
+                        {'rain||mm': pandas.Series({dt1: 2.0})})),
+                timeseries.Timeseries(pandas.DataFrame(
+                        {'water||m': pandas.Series({dt3: 3.0})}))])
+
+        self.assertEquals(merged.columns, ('water||m', 'rain||mm', 'water||m'))
+        self.assertEquals(list(merged.dataframe.index), [dt1, dt2, dt3])
+        self.assertEquals(merged.values(), [1.0])
+        self.assertEquals(merged.get_series('rain||mm').tolist(), [2.0])
+        self.assertEquals(merged.label_and_unit(merged.columns[1]),
+                          'rain (mm)')
+
+    def test_empty_timeseries_keep_their_columns(self):
+        dt1 = dates.utc(2014, 6, 24, 17, 31, 24)
+        merged = timeseries.merge([
+                timeseries.Timeseries({}),
+                timeseries.Timeseries({dt1: 2.0}),
+                timeseries.Timeseries({})])
+
+        self.assertEquals(merged.columns, ('data', 'data', 'data'))
+        self.assertEquals(list(merged.dataframe.index), [dt1])
+        self.assertTrue(
+            isinstance(merged.dataframe.index, pandas.DatetimeIndex))
+        self.assertEquals(merged.dataframe.iloc[:, 1].tolist(), [2.0])
+
+    def test_all_empty(self):
+        merged = timeseries.merge(
+            [timeseries.Timeseries({}), timeseries.Timeseries({})])
+        self.assertEquals(len(merged), 0)
+        self.assertEquals(len(merged.columns), 2)
+
+
+class TestDownsample(TestCase):
+    def setUp(self):
+        index = pandas.date_range(
+            '2014-01-01', periods=1000, freq='10min', tz='UTC')
+        values = numpy.sin(numpy.arange(1000) / 50.0)
+        values[500] = 100.0  # A peak
+        self.series = pandas.Series(values, index=index)
+        self.ts = timeseries.Timeseries(pandas.DataFrame(
+                {'data': self.series}))
+
+    def test_short_series_are_unchanged(self):
+        downsampled = self.ts.downsample(2000)
+        self.assertEquals(len(downsampled), 1000)
+
+    def test_lttb_keeps_max_points_including_first_and_last(self):
+        downsampled = self.ts.downsample(100).timeseries
+        self.assertEquals(len(downsampled), 100)
+        self.assertEquals(downsampled.index[0], self.series.index[0])
+        self.assertEquals(downsampled.index[-1], self.series.index[-1])
+        self.assertTrue(downsampled.index.is_monotonic_increasing)
+        self.assertEquals(downsampled.max(), 100.0)
+
+    def test_minmax_keeps_peaks(self):
+        downsampled = self.ts.downsample(100, method='minmax').timeseries
+        self.assertTrue(len(downsampled) <= 100)
+        self.assertEquals(downsampled.max(), 100.0)
+        self.assertEquals(downsampled.min(), self.series.min())
+
+    def test_unknown_method(self):
+        self.assertRaises(ValueError, self.ts.downsample, 100, 'average')
+
+    def test_too_few_points_raises_value_error(self):
+        self.assertRaises(ValueError, self.ts.downsample, 2)
+        self.assertRaises(ValueError, self.ts.downsample, 1, 'minmax')
+
+    def test_smallest_max_points_are_respected(self):
+        self.assertEquals(len(self.ts.downsample(3).timeseries), 3)
+        self.assertTrue(
+            len(self.ts.downsample(2, 'minmax').timeseries) <= 2)
+
+    def test_columns_are_kept(self):
+        ts = timeseries.Timeseries(pandas.DataFrame(
+                {'b||m': self.series, 'a': self.series * 2},
+                columns=['b||m', 'a']))
+        downsampled = ts.downsample(10)
+        self.assertEquals(downsampled.columns, ('b||m', 'a'))
+        self.assertEquals(len(downsampled.get_series('a')), 10)
+
+
+class TestBinaryFormats(TestCase):
+    def setUp(self):
+        dt1 = dates.utc(2014, 6, 24, 17, 31, 24)
+        dt2 = dates.utc(2014, 6, 24, 17, 32, 24)
+        self.ts = timeseries.merge([
+                timeseries.Timeseries(pandas.DataFrame(
+                        {'water||m': pandas.Series({dt1: 1.0, dt2: 2.0})})),
+                timeseries.Timeseries(pandas.DataFrame(
+                        {'water||m': pandas.Series({dt2: 3.0})}))])
+
+    def assertSameTimeseries(self, ts):
+        self.assertEquals(ts.columns, ('water||m', 'water||m'))
+        self.assertTrue(ts.dataframe.index.equals(self.ts.dataframe.index))
+        self.assertEquals(str(ts.dataframe.index.tz), 'UTC')
+        self.assertTrue(numpy.allclose(
+                ts.dataframe.values, self.ts.dataframe.values,
+                equal_nan=True))
+        self.assertEquals(ts.get_series('water||m').tolist(), [1.0, 2.0])
+
+    def test_npz_round_trip(self):
+        outfile = StringIO.StringIO()
+        self.ts.to_npz(outfile)
+        outfile.seek(0)
+        self.assertSameTimeseries(timeseries.Timeseries.from_npz(outfile))
+
+    @unittest.skipIf(timeseries.pyarrow is None, "pyarrow not installed")
+    def test_arrow_table_round_trip(self):
+        table = self.ts.to_arrow_table()
+        self.assertEquals(
+            table.schema.names, ['timestamp', 'water||m', 'water||m'])
+        self.assertSameTimeseries(
+            timeseries.Timeseries.from_arrow_table(table))
+
+    @unittest.skipIf(timeseries.pyarrow is None, "pyarrow not installed")
+    def test_feather_round_trip(self):
+        outfile = timeseries.pyarrow.BufferOutputStream()
+        self.ts.to_feather(outfile)
+        infile = timeseries.pyarrow.BufferReader(outfile.getvalue())
+        self.assertSameTimeseries(timeseries.Timeseries.from_feather(infile))
+
+    def test_arrow_formats_need_pyarrow(self):
+        with mock.patch('lizard_datasource.timeseries.pyarrow', None):
+            self.assertRaises(ImportError, self.ts.to_arrow_table)
+
+
+class TestSlicing(TestCase):
+    def setUp(self):
+        self.dt1 = dates.utc(2014, 6, 24, 17, 31, 24)
+        self.dt2 = dates.utc(2014, 6, 24, 17, 32, 24)
+        self.dt3 = dates.utc(2014, 6, 24, 17, 33, 24)
+        self.ts = timeseries.Timeseries({
+                self.dt1: 1.0, self.dt2: 2.0, self.dt3: 3.0})
+
+    def test_slice_includes_both_ends(self):
+        self.assertEquals(self.ts[self.dt1:self.dt2].values(), [1.0, 2.0])
+        self.assertEquals(self.ts[self.dt2:].values(), [2.0, 3.0])
+
+    def test_only_slices(self):
+        self.assertRaises(TypeError, lambda: self.ts[0])
+
+    def test_with_tail(self):
+        tail = timeseries.Timeseries({self.dt2: 20.0, self.dt3: 30.0})
+        self.assertEquals(
+            self.ts.with_tail(tail, self.dt2).values(), [1.0, 20.0, 30.0])
+
+    def test_with_tail_needs_same_columns(self):
+        tail = timeseries.Timeseries([{self.dt3: 30.0}])
+        self.assertRaises(ValueError, self.ts.with_tail, tail, self.dt3)
+
+
+class TestLazyTimeseries(TestCase):
+    def setUp(self):
+        self.dt1 = dates.utc(2014, 6, 24, 17, 31, 24)
+        self.dt2 = dates.utc(2014, 6, 24, 17, 32, 24)
+        self.loader = mock.MagicMock(
+            side_effect=lambda start, end: timeseries.Timeseries(
+                {self.dt1: 1.0, self.dt2: 2.0})[start:end])
+
+    def test_doesnt_load_until_needed(self):
+        ts = timeseries.LazyTimeseries(self.loader, self.dt1, self.dt2)
+        self.assertFalse(self.loader.called)
+        self.assertEquals(len(ts), 2)
+        self.assertEquals(ts.values(), [1.0, 2.0])
+        self.assertEquals(self.loader.call_count, 1)
+
+    def test_slicing_narrows_the_range_without_loading(self):
+        ts = timeseries.LazyTimeseries(self.loader)
+        sliced = ts[self.dt2:]
+        self.assertFalse(self.loader.called)
+        self.assertEquals(sliced.values(), [2.0])
+        self.loader.assert_called_with(self.dt2, None)
+
+    def test_latest_uses_latest_loader(self):
+        latest = pandas.Series({self.dt2: 2.0})
+        ts = timeseries.LazyTimeseries(
+            self.loader, latest_loader=lambda start, end: latest)
+        self.assertTrue(ts.latest() is latest)
+        self.assertFalse(self.loader.called)
+
+    def test_latest_loads_if_latest_loader_cant(self):
+        ts = timeseries.LazyTimeseries(
+            self.loader, latest_loader=lambda start, end: None)
+        self.assertEquals(ts.latest()[0], 2.0)
+
+    def test_loader_returning_none_is_empty(self):
+        ts = timeseries.LazyTimeseries(lambda start, end: None)
+        self.assertEquals(len(ts), 0)
+
+    def test_add_and_set_timezone_work(self):
+        ts = timeseries.LazyTimeseries(self.loader)
+        ts.add(timeseries.Timeseries({self.dt1: 3.0}))
+        ts.set_timezone(pytz.timezone('Europe/Amsterdam'))
+        self.assertEquals(len(ts.columns), 2)
+        self.assertEquals(str(ts.dataframe.index.tz), 'Europe/Amsterdam')
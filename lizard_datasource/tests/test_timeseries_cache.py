@@ -0,0 +1,193 @@
+"""Tests for lizard_datasource.timeseries_cache"""
+
+import mock
+
+from django.test import TestCase
+
+from lizard_datasource import dates
+from lizard_datasource import datasource
+from lizard_datasource import dummy_datasource
+from lizard_datasource import timeseries
+from lizard_datasource import timeseries_cache
+
+
+class TestCachedTimeseries(TestCase):
+    def setUp(self):
+        self.backend = timeseries_cache.LocMemBackend()
+        timeseries_cache.set_backend(self.backend)
+
+        self.ds = dummy_datasource.DummyDataSource()
+        self.ds.set_choices_made(datasource.ChoicesMade(first_letter='ae'))
+        datasource_model = self.ds.datasource_model
+        datasource_model.timeseries_cache_ttl = 60
+        datasource_model.save()
+
+        self.start = dates.utc(2012, 11, 13, 11, 30, 15)
+        self.end = dates.utc(2012, 11, 13, 13, 30, 15)
+
+    def tearDown(self):
+        timeseries_cache.set_backend(None)
+
+    def test_second_call_comes_from_cache(self):
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'timeseries',
+            side_effect=lambda l, s, e: timeseries.Timeseries(
+                self.ds._dummy_data())) as mocked:
+            ts1 = self.ds.cached_timeseries('almere', self.start, self.end)
+            ts2 = self.ds.cached_timeseries('almere', self.start, self.end)
+
+        self.assertEquals(mocked.call_count, 1)
+        self.assertEquals(ts1.values(), ts2.values())
+        self.assertEquals(ts2.values(), [15.0, 20.0])
+
+    def test_datasource_gets_rounded_window(self):
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'timeseries',
+            return_value=None) as mocked:
+            self.assertEquals(
+                self.ds.cached_timeseries('almere', self.start, self.end),
+                None)
+            self.ds.cached_timeseries('almere', self.start, self.end)
+
+        mocked.assert_called_once_with(
+            'almere', dates.utc(2012, 11, 13, 11, 30),
+            dates.utc(2012, 11, 13, 13, 31))
+
+    def test_no_caching_without_ttl(self):
+        datasource_model = self.ds.datasource_model
+        datasource_model.timeseries_cache_ttl = 0
+        datasource_model.save()
+
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'timeseries',
+            return_value=None) as mocked:
+            self.ds.cached_timeseries('almere', self.start, self.end)
+            self.ds.cached_timeseries('almere', self.start, self.end)
+
+        self.assertEquals(mocked.call_count, 2)
+
+    def test_key_depends_on_choices_made(self):
+        key1 = timeseries_cache.cache_key(self.ds, 'almere', None, None)
+        self.ds.set_choices_made(datasource.ChoicesMade(first_letter='gz'))
+        key2 = timeseries_cache.cache_key(self.ds, 'almere', None, None)
+        self.assertNotEquals(key1, key2)
+
+    def test_values_are_stored_as_npz_bytes(self):
+        self.ds.cached_timeseries('almere', self.start, self.end)
+        key = timeseries_cache.cache_key(
+            self.ds, 'almere', dates.utc(2012, 11, 13, 11, 30),
+            dates.utc(2012, 11, 13, 13, 31))
+        data = self.backend.get(key)
+        self.assertTrue(isinstance(data, bytes))
+        # The dummy datasource ignores the window, and what it returns
+        # is stored
+        self.assertEquals(
+            timeseries_cache.loads(data).values(), [10.0, 15.0, 20.0, 14.0])
+
+
+class TestGetBackend(TestCase):
+    def tearDown(self):
+        timeseries_cache.set_backend(None)
+
+    def test_backend_from_settings(self):
+        timeseries_cache._backend_configured = False
+        with self.settings(LIZARD_DATASOURCE_TIMESERIES_CACHE='django'):
+            backend = timeseries_cache.get_backend()
+        self.assertTrue(
+            isinstance(backend, timeseries_cache.DjangoCacheBackend))
+
+    def test_django_backend(self):
+        backend = timeseries_cache.DjangoCacheBackend()
+        backend.set('key', b'value', 10)
+        self.assertEquals(backend.get('key'), b'value')
+
+
+class TestIncrementalTimeseries(TestCase):
+    def setUp(self):
+        timeseries_cache.set_backend(timeseries_cache.LocMemBackend())
+
+        self.ds = dummy_datasource.DummyDataSource()
+        self.ds.set_choices_made(datasource.ChoicesMade(first_letter='ae'))
+        datasource_model = self.ds.datasource_model
+        datasource_model.timeseries_cache_ttl = 600
+        datasource_model.save()
+
+        # The "backend": values every hour
+        self.data = dict(
+            (dates.utc(2012, 11, 13, hour, 0), float(hour))
+            for hour in range(24))
+
+    def tearDown(self):
+        timeseries_cache.set_backend(None)
+
+    def fake_timeseries(self, location_id, start, end):
+        return timeseries.Timeseries(dict(
+                (timestamp, value)
+                for timestamp, value in self.data.items()
+                if start <= timestamp <= end))
+
+    def incremental(self, start_hour, end_hour):
+        return self.ds.incremental_timeseries(
+            'almere', dates.utc(2012, 11, 13, start_hour, 0),
+            dates.utc(2012, 11, 13, end_hour, 0))
+
+    def test_only_the_tail_is_fetched(self):
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'timeseries',
+            side_effect=self.fake_timeseries) as mocked:
+            self.assertEquals(
+                self.incremental(2, 5).values(), [2.0, 3.0, 4.0, 5.0])
+            result = self.incremental(3, 8)
+
+        self.assertEquals(result.values(), [3.0, 4.0, 5.0, 6.0, 7.0, 8.0])
+        mocked.assert_called_with(
+            'almere', dates.utc(2012, 11, 13, 5, 0),
+            dates.utc(2012, 11, 13, 8, 0))
+
+    def test_changed_last_value_is_replaced(self):
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'timeseries',
+            side_effect=self.fake_timeseries):
+            self.incremental(2, 5)
+            self.data[dates.utc(2012, 11, 13, 5, 0)] = 50.0
+            result = self.incremental(2, 6)
+
+        self.assertEquals(result.values(), [2.0, 3.0, 4.0, 50.0, 6.0])
+
+    def test_window_inside_cached_window_isnt_fetched(self):
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'timeseries',
+            side_effect=self.fake_timeseries) as mocked:
+            self.incremental(2, 8)
+            result = self.incremental(3, 4)
+
+        self.assertEquals(mocked.call_count, 1)
+        self.assertEquals(result.values(), [3.0, 4.0])
+
+    def test_cached_timeseries_is_trimmed_to_start(self):
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'timeseries',
+            side_effect=self.fake_timeseries):
+            self.incremental(2, 5)
+            self.incremental(4, 8)
+
+        key = timeseries_cache.cache_key(
+            self.ds, 'almere', None, None, prefix='tail')
+        cached_start, cached_end, data = (
+            timeseries_cache.get_backend().get(key))
+        self.assertEquals(cached_start, dates.utc(2012, 11, 13, 4, 0))
+        self.assertEquals(
+            timeseries_cache.loads(data).values(),
+            [4.0, 5.0, 6.0, 7.0, 8.0])
+
+    def test_earlier_start_fetches_everything(self):
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'timeseries',
+            side_effect=self.fake_timeseries) as mocked:
+            self.incremental(2, 5)
+            result = self.incremental(1, 5)
+
+        self.assertEquals(result.values(), [1.0, 2.0, 3.0, 4.0, 5.0])
+        mocked.assert_called_with(
+            'almere', dates.utc(2012, 11, 13, 1, 0),
+            dates.utc(2012, 11, 13, 5, 0))
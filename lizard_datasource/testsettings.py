@@ -58,6 +58,10 @@ LANGUAGES = (
 # load the internationalization machinery.
 USE_I18N = True
 
+# Datasources return timezone-aware datetimes (see dates.py), which
+# are stored in DatasourceCache.timestamp
+USE_TZ = True
+
 # SETTINGS_DIR allows media paths and so to be relative to this settings file
 # instead of hardcoded to c:\only\on\my\computer.
 SETTINGS_DIR = os.path.dirname(os.path.realpath(__file__))
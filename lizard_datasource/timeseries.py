@@ -1,16 +1,124 @@
 """Module for the Timeseries class. It is a wrapper around a pandas
 DataFrame."""
 
+import json
 import logging
+import numpy
 import pandas
 
+from StringIO import StringIO
 from itertools import izip
 
 from pandas import DataFrame
 from pandas import Series
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 logger = logging.getLogger(__name__)
 
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+# The smallest max_points each downsample method can keep to
+MIN_DOWNSAMPLE_POINTS = {'lttb': 3, 'minmax': 2}
+
+# Number of rows that iter_csv() formats at a time
+CSV_CHUNK_SIZE = 10000
+
+
+# Schema metadata key under which the Arrow formats store the column names
+ARROW_COLUMNS_KEY = b'lizard_datasource.columns'
+
+
+def _require_pyarrow(what):
+    if pyarrow is None:
+        raise ImportError("pyarrow is needed for {0}".format(what))
+
+
+def _to_bytes(text):
+    if isinstance(text, unicode):
+        return text.encode('utf8')
+    return text
+
+
+def _lttb_indices(x, y, max_points):
+    """Return the positions of the max_points points of (x, y) that
+    Largest-Triangle-Three-Buckets keeps. The first and last points are
+    always kept, the others are divided over max_points - 2 buckets and
+    from each bucket the point is kept that forms the largest triangle
+    with the previously kept point and the average of the next
+    bucket."""
+    n = len(x)
+    # Bucket i holds the points at positions edges[i]:edges[i + 1]
+    edges = (numpy.arange(max_points - 1) * (n - 2) //
+             (max_points - 2)) + 1
+
+    # Average of each bucket, computed with cumulative sums. The
+    # "bucket" after the last one is the last point.
+    counts = numpy.diff(edges)
+    cumulative_x = numpy.concatenate(([0], numpy.cumsum(x)))
+    cumulative_y = numpy.concatenate(([0], numpy.cumsum(y)))
+    average_x = numpy.append(
+        (cumulative_x[edges[1:]] - cumulative_x[edges[:-1]]) / counts, x[-1])
+    average_y = numpy.append(
+        (cumulative_y[edges[1:]] - cumulative_y[edges[:-1]]) / counts, y[-1])
+
+    indices = numpy.empty(max_points, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    # Each bucket depends on the point kept from the previous one, so
+    # we loop over the buckets, but not over the points
+    a = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        areas = numpy.abs(
+            (x[a] - average_x[i + 1]) * (y[start:end] - y[a]) -
+            (x[a] - x[start:end]) * (average_y[i + 1] - y[a]))
+        a = start + areas.argmax()
+        indices[i + 1] = a
+
+    return indices
+
+
+def _minmax_indices(y, max_points):
+    """Return the positions of the lowest and highest value in each
+    of max_points / 2 buckets of y, in order."""
+    buckets = max(max_points // 2, 1)
+    bucket = numpy.arange(len(y)) * buckets // len(y)
+    grouped = Series(y).groupby(bucket)
+    return numpy.union1d(grouped.idxmin().values, grouped.idxmax().values)
+
+
+def downsample_series(series, max_points, method='lttb'):
+    """Return series (a pandas Series with a DatetimeIndex, without
+    missing values) with at most max_points points. See
+    Timeseries.downsample()."""
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(
+            "Unknown downsample method {0!r}, use one of {1}".format(
+                method, ", ".join(DOWNSAMPLE_METHODS)))
+    if max_points < MIN_DOWNSAMPLE_POINTS[method]:
+        raise ValueError(
+            "Downsample method {0!r} needs max_points of at least {1}".format(
+                method, MIN_DOWNSAMPLE_POINTS[method]))
+
+    if len(series) <= max_points:
+        return series
+
+    if method == 'lttb':
+        # Seconds since the first point, small enough for cumsum
+        nanoseconds = pandas.DatetimeIndex(series.index).asi8
+        x = (nanoseconds - nanoseconds[0]) / 1e9
+        indices = _lttb_indices(
+            x, series.values.astype(float), max_points)
+    else:
+        indices = _minmax_indices(series.values, max_points)
+
+    return series.iloc[indices]
+
 
 class Timeseries(object):
     def __init__(self, data):
@@ -28,6 +136,9 @@ class Timeseries(object):
         This works like a pandas DataFrame, except we keep track of
         the order of column names."""
 
+        # Things computed from the first series, see _cached()
+        self._cache = {}
+
         if isinstance(data, DataFrame):
             self._dataframe = data
             self._columns = tuple(data.columns)
@@ -36,47 +147,200 @@ class Timeseries(object):
             self._dataframe = DataFrame({'data': series})
             self._columns = ('data',)
         else:
-            self._dataframe = DataFrame(dict([
-                        ('data_{0}'.format(i), series)
-                        for i, series in enumerate(data)]))
             self._columns = tuple(
                 'data_{0}'.format(i) for i, series in enumerate(data))
+            self._dataframe = DataFrame(dict([
+                        ('data_{0}'.format(i), series)
+                        for i, series in enumerate(data)]),
+                                        columns=list(self._columns))
 
     def add(self, timeseries):
         """Add the columns from timeseries to the dataframe of this
-        timeseries."""
-        self._dataframe = self._dataframe.combineAdd(timeseries._dataframe)
-        self._columns = self.columns + timeseries.columns
+        timeseries. To add several timeseries, merge() them all at
+        once instead."""
+        merged = merge([self, timeseries])
+        self._dataframe = merged._dataframe
+        self._columns = merged._columns
+        self._cache = {}
 
     @property
     def dataframe(self):
         return self._dataframe
 
+    def _cached(self, key, compute):
+        """Return the cached result of compute(), which is computed
+        from the first series. The cache is emptied when the dataframe
+        is replaced (add() and set_timezone()), so don't change the
+        dataframe in place."""
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
     @property
     def timeseries(self):
         """Return the first of the series in dataframe"""
-        return self._dataframe[self._columns[0]].dropna()
+        return self._cached(
+            'timeseries',
+            lambda: self._dataframe.iloc[:, 0].dropna())
+
+    def downsample(self, max_points, method='lttb'):
+        """Return a new Timeseries in which each series has at most
+        max_points points, for graphs that can't show more anyway.
+
+        Method 'lttb' (Largest-Triangle-Three-Buckets) keeps the points
+        that keep the shape of the line best. Method 'minmax' divides
+        each series in max_points / 2 buckets and keeps the lowest and
+        highest point of each, so that peaks are never lost.
+
+        The series are downsampled separately and then combined again,
+        so the dataframe can have more rows than max_points if the
+        series have different timestamps.
+
+        LTTB always keeps the first and last point, so it needs a
+        max_points of at least 3, and minmax at least 2. Smaller values
+        raise ValueError."""
+        dataframe = pandas.concat([
+                downsample_series(
+                    self._dataframe.iloc[:, i].dropna(), max_points, method)
+                for i in range(len(self._columns))], axis=1)
+        dataframe.columns = list(self._columns)
+        return Timeseries(dataframe)
 
     def get_series(self, columnname):
-        return self._dataframe[columnname].dropna()
+        """Return the series of the first column with that name.
+        Columns are looked up by position, because merged timeseries
+        can have several columns with the same name."""
+        return self._dataframe.iloc[
+            :, self._columns.index(columnname)].dropna()
 
     def to_csv(self, outfile, sep=',', timezone=None, date_format='%Y-%m-%d %H:%M',
                header_date_format='Datum + tijd'):
-        """Note: changes the timezone of all datetimes!
+        """Write the data of all timeseries to a CSV file. See
+        iter_csv(), this timeseries isn't changed."""
+        for chunk in self.iter_csv(
+            sep=sep, timezone=timezone, date_format=date_format,
+            header_date_format=header_date_format):
+            outfile.write(chunk)
 
-        Write the data of all timeseries to a CSV file."""
-        if timezone is not None:
-            self.set_timezone(timezone)
+    def iter_csv(self, sep=',', timezone=None, date_format='%Y-%m-%d %H:%M',
+                 header_date_format='Datum + tijd', chunk_size=CSV_CHUNK_SIZE):
+        """Yield the data of all timeseries as CSV, as byte strings of
+        chunk_size rows each (the first is the header), for instance
+        for a Django StreamingHttpResponse. If timezone (a pytz timezone
+        object) is given, the dates are converted to it one chunk at a
+        time."""
         headers = [header_date_format] + [
             self.label_and_unit(column) for column in self.columns]
-        outfile.write(sep.join(headers) + "\n")
-        self._dataframe.to_csv(outfile, sep=sep, mode='a', header=None,
-                               date_format=date_format)
+        yield _to_bytes(sep.join(headers) + "\n")
+
+        for start in range(0, len(self._dataframe), chunk_size):
+            chunk = self._dataframe.iloc[start:start + chunk_size]
+            if timezone is not None:
+                chunk = chunk.tz_convert(timezone)
+            outfile = StringIO()
+            chunk.to_csv(outfile, sep=sep, header=None,
+                         date_format=date_format)
+            yield _to_bytes(outfile.getvalue())
+
+    def _utc_index(self):
+        """Return the index as int64 nanoseconds since 1970 UTC."""
+        return pandas.DatetimeIndex(self._dataframe.index).asi8
+
+    def to_npz(self, outfile):
+        """Write all timeseries to outfile (a filename or file object)
+        in NumPy's .npz format: 'index' has the dates as int64
+        nanoseconds since 1970 UTC, 'values' the columns as an (n,
+        columns) float array and 'columns' the column names."""
+        numpy.savez(
+            outfile,
+            index=self._utc_index(),
+            values=numpy.asarray(self._dataframe.values, dtype=float),
+            columns=numpy.array(
+                [unicode(column) for column in self._columns]))
+
+    @classmethod
+    def from_npz(cls, infile):
+        """Return the Timeseries that to_npz() wrote to infile."""
+        with numpy.load(infile) as data:
+            dataframe = DataFrame(
+                data['values'],
+                index=pandas.DatetimeIndex(data['index']).tz_localize('UTC'))
+            dataframe.columns = data['columns'].tolist()
+        return cls(dataframe)
+
+    def to_arrow_table(self):
+        """Return all timeseries as a pyarrow Table. The first column,
+        'timestamp', has the dates in UTC, the other columns are the
+        timeseries. The column names are also stored in the schema
+        metadata, because they don't have to be unique."""
+        _require_pyarrow("Arrow tables")
+        arrays = [pyarrow.array(
+                self._utc_index(), type=pyarrow.timestamp('ns', tz='UTC'))]
+        arrays.extend(
+            pyarrow.array(
+                numpy.asarray(self._dataframe.iloc[:, i].values, dtype=float),
+                from_pandas=True)
+            for i in range(len(self._columns)))
+        table = pyarrow.Table.from_arrays(
+            arrays, names=['timestamp'] + list(self._columns))
+        return table.replace_schema_metadata({
+                ARROW_COLUMNS_KEY: json.dumps(list(self._columns))})
+
+    @classmethod
+    def from_arrow_table(cls, table):
+        """Return the Timeseries of a table made by to_arrow_table().
+        Columns are read by position."""
+        metadata = table.schema.metadata or {}
+        if ARROW_COLUMNS_KEY in metadata:
+            columns = json.loads(metadata[ARROW_COLUMNS_KEY])
+        else:
+            columns = table.schema.names[1:]
+
+        index = pandas.DatetimeIndex(table.column(0).to_pandas())
+        if index.tz is None:
+            index = index.tz_localize('UTC')
+        dataframe = DataFrame(dict(
+                (i, numpy.asarray(table.column(i + 1).to_pandas(),
+                                  dtype=float))
+                for i in range(len(columns))),
+                              index=index, columns=range(len(columns)))
+        dataframe.columns = columns
+        return cls(dataframe)
+
+    def to_feather(self, outfile):
+        """Write all timeseries to outfile as an Arrow IPC file (the
+        format of Feather version 2), see to_arrow_table(). Needs
+        pyarrow."""
+        table = self.to_arrow_table()
+        writer = pyarrow.ipc.new_file(outfile, table.schema)
+        try:
+            writer.write_table(table)
+        finally:
+            writer.close()
+
+    @classmethod
+    def from_feather(cls, infile):
+        _require_pyarrow("Feather files")
+        return cls.from_arrow_table(pyarrow.ipc.open_file(infile).read_all())
+
+    def to_parquet(self, outfile):
+        """Write all timeseries to outfile as Parquet, see
+        to_arrow_table(). Needs pyarrow with Parquet support."""
+        table = self.to_arrow_table()
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, outfile)
+
+    @classmethod
+    def from_parquet(cls, infile):
+        _require_pyarrow("Parquet files")
+        import pyarrow.parquet
+        return cls.from_arrow_table(pyarrow.parquet.read_table(infile))
 
     def set_timezone(self, timezone):
         """Sets this timezone on all datetimes. Timezone is a pytz timezone
         object."""
         self._dataframe = self._dataframe.tz_convert(timezone)
+        self._cache = {}
 
     @property
     def columns(self):
@@ -101,7 +365,7 @@ class Timeseries(object):
         return self.timeseries.keys()
 
     def values(self):
-        return list(self.timeseries)
+        return self.timeseries.values.tolist()
 
     def latest(self):
         return self.timeseries.tail(1)
@@ -110,5 +374,159 @@ class Timeseries(object):
         return [[key, value]
                 for key, value in izip(self.dates(), self.values())]
 
+    def data_epoch_ms(self):
+        """Return the first series as an (n, 2) float array of
+        milliseconds since 1970-01-01 UTC and values, like Flot wants
+        them. Made from the NumPy arrays of the series, without a loop
+        over the points. Don't change it, it is cached."""
+        def compute():
+            series = self.timeseries
+            data = numpy.empty((len(series), 2), dtype=float)
+            data[:, 0] = pandas.DatetimeIndex(
+                series.index).asi8 // 1000000
+            data[:, 1] = series.values
+            return data
+        return self._cached('data_epoch_ms', compute)
+
+    def data_json(self):
+        """Return data_epoch_ms() as a JSON byte string, a list of
+        [milliseconds, value] lists. Also cached."""
+        def compute():
+            data = self.data_epoch_ms()
+            return json.dumps(list(izip(
+                        data[:, 0].astype(numpy.int64).tolist(),
+                        data[:, 1].tolist()))).encode('utf8')
+        return self._cached('data_json', compute)
+
     def __len__(self):
         return len(self._dataframe) if self._dataframe is not None else 0
+
+    def __getitem__(self, key):
+        """ts[start:end] returns a Timeseries with only the rows from
+        start up to and including end (UTC datetimes, either can be
+        None)."""
+        if not isinstance(key, slice) or key.step is not None:
+            raise TypeError("Timeseries can only be sliced by [start:end]")
+        return Timeseries(self._dataframe.loc[key.start:key.stop])
+
+    def with_tail(self, tail, start_datetime):
+        """Return a new Timeseries with the rows of this one from
+        before start_datetime, followed by the rows of tail (a
+        Timeseries with the same columns)."""
+        if tail.columns != self.columns:
+            raise ValueError("Tail has different columns")
+        head = self._dataframe[self._dataframe.index < start_datetime]
+
+        # Concatenate by position, column names can repeat
+        frames = [head.copy(), tail.dataframe.copy()]
+        for frame in frames:
+            frame.columns = range(len(self._columns))
+        dataframe = pandas.concat(frames)
+        dataframe.columns = list(self._columns)
+        return Timeseries(dataframe)
+
+
+class LazyTimeseries(Timeseries):
+    """A Timeseries that only loads its data when it is needed.
+
+    Loader is called as loader(start_datetime, end_datetime) and should
+    return a Timeseries or None. Slicing a LazyTimeseries that isn't
+    loaded yet gives a LazyTimeseries for the smaller range, without
+    loading anything. If latest_loader is given, latest() calls it the
+    same way before the data is loaded; it should return what
+    Timeseries.latest() returns, or None if it can't."""
+
+    def __init__(self, loader, start_datetime=None, end_datetime=None,
+                 latest_loader=None):
+        self._loader = loader
+        self._latest_loader = latest_loader
+        self.start_datetime = start_datetime
+        self.end_datetime = end_datetime
+        self._loaded = None
+        self._cache = {}
+
+    @property
+    def is_loaded(self):
+        return self._loaded is not None
+
+    def _load(self):
+        if self._loaded is None:
+            loaded = self._loader(self.start_datetime, self.end_datetime)
+            if loaded is None:
+                loaded = Timeseries(DataFrame({'data': Series([])}))
+            self._loaded = loaded
+        return self._loaded
+
+    # Timeseries methods use these, so they load the data
+    @property
+    def _dataframe(self):
+        return self._load()._dataframe
+
+    @_dataframe.setter
+    def _dataframe(self, dataframe):
+        self._load()._dataframe = dataframe
+
+    @property
+    def _columns(self):
+        return self._load()._columns
+
+    @_columns.setter
+    def _columns(self, columns):
+        self._load()._columns = columns
+
+    def latest(self):
+        if self._loaded is None and self._latest_loader is not None:
+            latest = self._latest_loader(
+                self.start_datetime, self.end_datetime)
+            if latest is not None:
+                return latest
+        return super(LazyTimeseries, self).latest()
+
+    def __getitem__(self, key):
+        if self._loaded is not None:
+            return super(LazyTimeseries, self).__getitem__(key)
+        if not isinstance(key, slice) or key.step is not None:
+            raise TypeError("Timeseries can only be sliced by [start:end]")
+
+        start_datetime = self.start_datetime
+        if key.start is not None and (
+            start_datetime is None or key.start > start_datetime):
+            start_datetime = key.start
+        end_datetime = self.end_datetime
+        if key.stop is not None and (
+            end_datetime is None or key.stop < end_datetime):
+            end_datetime = key.stop
+
+        return LazyTimeseries(
+            self._loader, start_datetime, end_datetime, self._latest_loader)
+
+
+def merge(timeseries_list):
+    """Return a new Timeseries with all the columns of all the
+    Timeseries in timeseries_list, in order. Columns with the same name
+    are kept as separate columns. The indexes are joined once, by a
+    single concat of all the dataframes, so merging N timeseries costs
+    about as much as their total number of points."""
+    timeseries_list = list(timeseries_list)
+    columns = []
+    for timeseries in timeseries_list:
+        columns.extend(timeseries.columns)
+
+    frames = [timeseries.dataframe for timeseries in timeseries_list]
+
+    # Empty timeseries (like Timeseries({})) don't have a DatetimeIndex,
+    # and pandas can't join that with one that has a timezone. Give them
+    # an empty index like that of the others.
+    tz = None
+    for frame in frames:
+        if len(frame) and isinstance(frame.index, pandas.DatetimeIndex):
+            tz = frame.index.tz
+            break
+    for i, frame in enumerate(frames):
+        if not len(frame):
+            frames[i] = frame = frame.copy()
+            frame.index = pandas.DatetimeIndex([], tz=tz)
+
+    dataframe = pandas.concat(frames, axis=1)
+    dataframe.columns = columns
+    return Timeseries(dataframe)
@@ -0,0 +1,248 @@
+"""A shared cache for the results of DataSource.timeseries(), used by
+DataSource.cached_timeseries(), and an incremental one that only asks
+for the new tail of a timeseries, used by
+DataSource.incremental_timeseries().
+
+The cache is off unless the LIZARD_DATASOURCE_TIMESERIES_CACHE setting
+is 'locmem' (an LRU cache in each process) or 'django' (Django's
+default cache), and then only for datasources whose DatasourceModel has
+a timeseries_cache_ttl. Timeseries are stored in NumPy's .npz format,
+see Timeseries.to_npz()."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import datetime
+import hashlib
+import io
+import math
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from lizard_datasource import dates
+from lizard_datasource import timeseries
+from lizard_datasource.functools import LRUCache
+
+SETTING = 'LIZARD_DATASOURCE_TIMESERIES_CACHE'
+
+# Start and end datetimes are rounded to this many seconds, so that
+# requests for about the same window use the same cached timeseries
+WINDOW_ROUNDING = 60
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=dates.UTC)
+
+
+class LocMemBackend(object):
+    """Keeps the cached timeseries in this process."""
+
+    def __init__(self, maxsize=1000):
+        self._cache = LRUCache(maxsize=maxsize)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        self._cache.set(key, value, ttl=ttl)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class DjangoCacheBackend(object):
+    """Keeps the cached timeseries in one of the Django CACHES, so
+    that processes can share them."""
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return get_cache(self.alias)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+
+BACKENDS = {
+    'locmem': LocMemBackend,
+    'django': DjangoCacheBackend,
+    }
+
+_backend = None
+_backend_configured = False
+
+
+def get_backend():
+    """Return the backend chosen in the settings, or None if there is
+    no cache."""
+    global _backend, _backend_configured
+    if not _backend_configured:
+        name = getattr(settings, SETTING, None)
+        _backend = BACKENDS[name]() if name else None
+        _backend_configured = True
+    return _backend
+
+
+def set_backend(backend):
+    """Use backend (an object with get(), set() and clear() like the
+    backends above, or None for no cache) instead of the one from the
+    settings."""
+    global _backend, _backend_configured
+    _backend = backend
+    _backend_configured = True
+
+
+def _round(datetime_object, round_up):
+    if datetime_object is None:
+        return None
+    seconds = (dates.to_utc(datetime_object) - EPOCH).total_seconds()
+    if round_up:
+        seconds = math.ceil(seconds / WINDOW_ROUNDING) * WINDOW_ROUNDING
+    else:
+        seconds = math.floor(seconds / WINDOW_ROUNDING) * WINDOW_ROUNDING
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def cache_key(datasource, location_id, start_datetime, end_datetime,
+              prefix='timeseries'):
+    """Return the cache key for the timeseries of location_id in the
+    current layer (the choices made) of datasource. The datetimes
+    should be rounded already."""
+    key = '{0}|{1}|{2}|{3}|{4}'.format(
+        datasource.datasource_model.id,
+        datasource.get_choices_made().json(),
+        location_id,
+        start_datetime.isoformat() if start_datetime else None,
+        end_datetime.isoformat() if end_datetime else None)
+    return 'lizard_datasource.{0}.{1}'.format(
+        prefix, hashlib.sha1(key.encode('utf8')).hexdigest())
+
+
+def dumps(result):
+    """Return the result of DataSource.timeseries() (a Timeseries or
+    None) as bytes."""
+    if result is None:
+        return b''
+    outfile = io.BytesIO()
+    result.to_npz(outfile)
+    return outfile.getvalue()
+
+
+def loads(data):
+    if not data:
+        return None
+    return timeseries.Timeseries.from_npz(io.BytesIO(data))
+
+
+def cached_timeseries(
+    datasource, location_id, start_datetime=None, end_datetime=None):
+    """Return datasource.timeseries(location_id, start_datetime,
+    end_datetime), from the cache if possible.
+
+    The datasource is asked for a window rounded to WINDOW_ROUNDING
+    seconds, so that it can be reused for similar requests, and the
+    result is sliced to the window that was asked for."""
+    backend = get_backend()
+    ttl = backend and datasource.datasource_model.timeseries_cache_ttl
+    if not ttl:
+        return datasource.timeseries(
+            location_id, start_datetime, end_datetime)
+
+    start = _round(start_datetime, round_up=False)
+    end = _round(end_datetime, round_up=True)
+    key = cache_key(datasource, location_id, start, end)
+
+    data = backend.get(key)
+    if data is None:
+        result = datasource.timeseries(location_id, start, end)
+        backend.set(key, dumps(result), ttl)
+    else:
+        result = loads(data)
+
+    if result is not None and (
+        start != start_datetime or end != end_datetime):
+        result = result[start_datetime:end_datetime]
+    return result
+
+
+def _fetch_tail(datasource, location_id, result, fetched_until, end):
+    """Return result with the part of the timeseries after its last
+    timestamp (or after fetched_until, if it has no data) up to end
+    fetched from the datasource. Raises ValueError if the columns of
+    the new part are different."""
+    if result is not None and len(result):
+        tail_start = result.dataframe.index[-1]
+    else:
+        tail_start = fetched_until
+
+    tail = datasource.timeseries(location_id, tail_start, end)
+    if tail is None or not len(tail):
+        return result
+    if result is None or not len(result):
+        return tail
+    return result.with_tail(tail, tail_start)
+
+
+def incremental_timeseries(
+    datasource, location_id, start_datetime=None, end_datetime=None):
+    """Return datasource.timeseries(location_id, start_datetime,
+    end_datetime), using what was fetched before.
+
+    For each location the fetched timeseries is kept in the cache with
+    the window it covers. If a later request starts within that window,
+    only the part from the last cached timestamp up to the new end is
+    asked from the datasource and added to it, and the part before the
+    request's start_datetime is dropped. An end_datetime of None means
+    now."""
+    backend = get_backend()
+    ttl = backend and datasource.datasource_model.timeseries_cache_ttl
+    if not ttl:
+        return datasource.timeseries(
+            location_id, start_datetime, end_datetime)
+
+    start = dates.to_utc(start_datetime) if start_datetime else None
+    end = dates.to_utc(end_datetime) if end_datetime else dates.utc_now()
+    key = cache_key(datasource, location_id, None, None, prefix='tail')
+
+    cached = backend.get(key)
+    if cached is not None:
+        cached_start, cached_end, data = cached
+        if cached_start is not None and (
+            start is None or start < cached_start):
+            # We don't have the beginning
+            cached = None
+
+    if cached is not None:
+        result = loads(data)
+        if end > cached_end:
+            try:
+                result = _fetch_tail(
+                    datasource, location_id, result, cached_end, end)
+            except ValueError:
+                # The columns changed, start over
+                cached = None
+            else:
+                if start is not None:
+                    # Forget what came before this request, so that the
+                    # cached timeseries doesn't keep growing while a
+                    # graph is refreshed
+                    if result is not None:
+                        result = result[start:]
+                    cached_start = start
+                backend.set(key, (cached_start, end, dumps(result)), ttl)
+
+    if cached is None:
+        result = datasource.timeseries(location_id, start, end)
+        backend.set(key, (start, end, dumps(result)), ttl)
+
+    if result is not None:
+        result = result[start:end if end_datetime else None]
+    return result
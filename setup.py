@@ -19,6 +19,7 @@ install_requires = [
     'mock',
     'south',
     'pandas',
+    'numpy',
     'django-colorful',
     'factory_boy'
     ],
@@ -42,7 +43,8 @@ setup(name='lizard-datasource',
       zip_safe=False,
       install_requires=install_requires,
       tests_require=tests_require,
-      extras_require={'test': tests_require},
+      extras_require={'test': tests_require,
+                      'arrow': ['pyarrow']},
       entry_points={
           'console_scripts': [
           ],